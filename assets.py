@@ -0,0 +1,54 @@
+"""
+Loading everything the game needs off the disk before it starts.
+
+Whatever needs loading is add()ed to an Assets as a function to call, and
+what to call it with. start() works through them on a background thread, so
+the main thread is free to draw a loading screen in the meantime; wait()
+for it to finish. After that, nothing should need the disk again.
+"""
+
+import sys
+import threading
+
+class Assets(object):
+  def __init__(self):
+    self.jobs = []
+    self.done = 0
+    self.error = None
+    self.thread = None
+
+  def add(self, load, *args):
+    self.jobs.append((load, args))
+
+  def progress(self):
+    """ How much has been loaded so far, from 0 to 1. """
+    if len(self.jobs) == 0: return 1.0
+    return self.done / float(len(self.jobs))
+
+  def finished(self):
+    return self.done == len(self.jobs) or self.error is not None
+
+  def load(self):
+    """ Load everything, right here on this thread. """
+    for load, args in self.jobs[self.done:]:
+      load(*args)
+      self.done += 1
+
+  def start(self):
+    self.thread = threading.Thread(target=self.work)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def work(self):
+    try:
+      self.load()
+    except Exception:
+      self.error = sys.exc_info()
+
+  def wait(self):
+    """ Wait for start() to finish, and raise whatever went wrong, if
+    anything did. """
+    self.thread.join()
+
+    if self.error is not None:
+      raise self.error[0], self.error[1], self.error[2]
@@ -0,0 +1,184 @@
+"""
+Music and sound effects.
+
+The soundtrack is two versions of the same tune, a normal one and a dark
+one, crossfaded depending on how sane you are. The normal one streams
+through pygame.mixer.music, so it's never decoded all at once. The dark one
+has to be a Sound to play alongside it. It starts at the same time as the
+normal one, silent, so the two are always in step, and going insane is
+only a matter of turning it up.
+
+preload() reads the normal track into memory (still compressed) and
+decodes the dark one, after which neither of them touches the disk again.
+"""
+
+import io
+import threading
+import time
+import pygame
+
+# How long a full crossfade takes, and how often the volumes are updated
+# while one is happening, in seconds.
+CROSSFADE_TIME = 0.5
+CROSSFADE_STEP = 1 / 60.0
+
+class Soundtrack(object):
+  """ Plays the soundtrack. set_dark() says which way to fade; the fading
+  itself happens on a timer thread, however fast or slow the frames are.
+  stop() that before pygame.quit(). """
+  def __init__(self, normal_file, dark_file):
+    self.normal_file = normal_file
+    self.dark_file = dark_file
+
+    # 0 is all normal, 1 is all dark.
+    self.mix = 0.0
+    self.target = 0.0
+
+    self.normal_data = None
+
+    self.dark = None
+    self.channel = None
+    self.wake = threading.Event()
+    self.stopping = False
+    self.thread = None
+
+  def preload(self):
+    self.normal_data = read(self.normal_file)
+    self.dark = pygame.mixer.Sound(self.dark_file)
+
+  def start(self):
+    if self.dark is None:
+      self.dark = pygame.mixer.Sound(self.dark_file)
+
+    pygame.mixer.music.load(source(self.normal_file, self.normal_data))
+    pygame.mixer.music.set_volume(1.0)
+    self.channel = self.dark.play(-1)
+    self.channel.set_volume(0.0)
+    pygame.mixer.music.play(-1)
+
+    self.thread = threading.Thread(target=self.fade)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    """ Stop the fading, for good. Nothing touches the mixer after this. """
+    if self.thread is None: return
+
+    self.stopping = True
+    self.wake.set()
+    self.thread.join()
+    self.thread = None
+
+  def set_dark(self, dark):
+    target = 1.0 if dark else 0.0
+    if target == self.target: return
+
+    self.target = target
+    self.wake.set()
+
+  def fade(self):
+    step = CROSSFADE_STEP / CROSSFADE_TIME
+
+    while not self.stopping:
+      if self.mix == self.target:
+        # Nothing to do until somebody changes their mind (or stops).
+        self.wake.wait()
+        self.wake.clear()
+        continue
+
+      if self.mix < self.target:
+        self.mix = min(self.target, self.mix + step)
+      else:
+        self.mix = max(self.target, self.mix - step)
+
+      pygame.mixer.music.set_volume(1 - self.mix)
+      self.channel.set_volume(self.mix)
+
+      time.sleep(CROSSFADE_STEP)
+
+def read(path):
+  f = open(path, "rb")
+  data = f.read()
+  f.close()
+  return data
+
+def source(path, data):
+  """ Something pygame can load a sound from: data if it's been read in
+  already, otherwise the file. """
+  if data is None: return path
+  return io.BytesIO(data)
+
+class SoundEffects(object):
+  """ Short sounds, decoded once up front and played on a pool of reserved
+  channels, so they can't drown each other (or the music) out.
+
+  play() only asks for a sound. update(), once a frame, plays everything
+  that was asked for that frame, once per sound however many times it was
+  asked for. Each sound gets at most max_voices channels; past that it
+  restarts its own oldest voice. With every channel busy, a sound takes over
+  the oldest voice of a sound with the same or lower priority, or doesn't
+  play at all.
+
+  Until load() is called (which it isn't in DEBUG or headless), none of
+  this does anything. """
+  def __init__(self):
+    self.sounds = {}
+    self.channels = []
+    self.voices = []
+    self.requested = []
+    self.started = 0
+
+  def load(self, files, channels=8):
+    """ files is name -> (filename, volume, max_voices, priority). """
+    pygame.mixer.set_num_channels(pygame.mixer.get_num_channels() + channels)
+    pygame.mixer.set_reserved(channels)
+    self.channels = [pygame.mixer.Channel(i) for i in range(channels)]
+
+    # (name, priority, when it started) for whatever each channel last played.
+    self.voices = [None] * channels
+
+    for name, (f, volume, max_voices, priority) in files.items():
+      sound = pygame.mixer.Sound(f)
+      sound.set_volume(volume)
+      self.sounds[name] = (sound, max_voices, priority)
+
+  def play(self, name):
+    if name in self.sounds and name not in self.requested:
+      self.requested.append(name)
+
+  def update(self):
+    requested = self.requested
+    self.requested = []
+
+    for name in requested:
+      i = self.pick_channel(name)
+      if i is None: continue
+
+      sound, max_voices, priority = self.sounds[name]
+      self.channels[i].play(sound)
+      self.voices[i] = (name, priority, self.started)
+      self.started += 1
+
+  def pick_channel(self, name):
+    sound, max_voices, priority = self.sounds[name]
+
+    playing = []
+    free = None
+    for i, channel in enumerate(self.channels):
+      if self.voices[i] is None or not channel.get_busy():
+        if free is None: free = i
+      else:
+        playing.append(i)
+
+    mine = [i for i in playing if self.voices[i][0] == name]
+    if len(mine) >= max_voices:
+      return self.oldest(mine)
+
+    if free is not None:
+      return free
+
+    return self.oldest([i for i in playing if self.voices[i][1] <= priority])
+
+  def oldest(self, channels):
+    if len(channels) == 0: return None
+    return min(channels, key=lambda i: self.voices[i][2])
@@ -0,0 +1,54 @@
+"""
+Bakes the lighting of every room in laderp.bmp, as it is before anybody
+touches anything, into lights.bake. The game uses the baked lighting until
+something in the room that affects it moves.
+
+The game ignores a bake made from a different laderp.bmp. Re-run this whenever
+laderp.bmp changes, and bump main.BAKE_MAGIC whenever the lighting code does.
+
+Usage:
+    python bake_lights.py
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import multiprocessing
+import cPickle as pickle
+import pygame
+import main
+
+world = None
+
+def load_world():
+  global world
+  world = pygame.image.load(main.MAP_FILE)
+
+def bake(room):
+  mx, my = room
+  mapdata = world.subsurface((mx * main.MAP_SIZE_TILES, my * main.MAP_SIZE_TILES, main.MAP_SIZE_TILES, main.MAP_SIZE_TILES))
+
+  try:
+    codes = main.room_codes(mapdata)
+  except KeyError:
+    # Colors that don't mean anything. Not a real room.
+    return room, None
+
+  return room, main.bake_room_lighting(codes)
+
+if __name__ == "__main__":
+  load_world()
+  width, height = world.get_size()
+  rooms = [(x, y) for x in range(width // main.MAP_SIZE_TILES) for y in range(height // main.MAP_SIZE_TILES)]
+
+  pool = multiprocessing.Pool(initializer=load_world)
+  baked = dict((room, bake) for room, bake in pool.map(bake, rooms) if bake is not None)
+  pool.close()
+  pool.join()
+
+  f = open(main.BAKED_LIGHT_FILE, "wb")
+  f.write(main.BAKE_HEADER.pack(main.BAKE_MAGIC, main.map_digest()))
+  pickle.dump(baked, f, pickle.HIGHEST_PROTOCOL)
+  f.close()
+
+  print "Baked %d of %d rooms into %s." % (len(baked), len(rooms), main.BAKED_LIGHT_FILE)
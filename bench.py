@@ -0,0 +1,151 @@
+"""
+Micro benchmarks for the slow bits of the game.
+
+Usage:
+    python bench.py [name ...]
+
+With no names, runs all of them.
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import sys
+import random
+import timeit
+import subprocess
+import pygame
+import blur
+import level
+
+def time_it(f, number):
+  """ Best of three, in milliseconds per call. """
+  return min(timeit.repeat(f, number=number, repeat=3)) / number * 1000
+
+def lightmap(size):
+  """ Something that looks like what Light blurs: blocks of alpha. """
+  surf = pygame.Surface(size, pygame.SRCALPHA)
+  rand = random.Random(0)
+
+  for x in range(0, size[0], 20):
+    for y in range(0, size[1], 20):
+      surf.fill((0, 0, 0, rand.randint(0, 180)), (x, y, 20, 20))
+
+  return surf
+
+def bench_blur():
+  size = (400, 400)
+  surf = lightmap(size)
+  blurs = [("Blur(FAST)", blur.Blur(blur.FAST)),
+           ("Blur(SMOOTH)", blur.Blur(blur.SMOOTH)),
+           ("Blur(GAUSSIAN)", blur.Blur(blur.GAUSSIAN))]
+
+  print "blur, %dx%d, ms per call" % size
+  print "%-16s %8s %8s %8s" % ("", "amt 5", "amt 10", "amt 15")
+
+  amts = (5.0, 10.0, 15.0)
+  times = [time_it(lambda: blur.smoothscale_blur(surf, amt), 200) for amt in amts]
+  print "%-16s %8.3f %8.3f %8.3f" % tuple(["smoothscale_blur"] + times)
+
+  for name, b in blurs:
+    number = 10 if b.quality == blur.GAUSSIAN else 200
+    times = [time_it(lambda: b.blur(surf, amt), number) for amt in amts]
+    print "%-16s %8.3f %8.3f %8.3f" % tuple([name] + times)
+
+def big_room(size):
+  """ A compiled stress room, size tiles square, with the same handful of
+  lights and enemies near the top left however big it is. """
+  import main
+  import stress
+
+  tiles = stress.layout(size)
+  spawns = [ (main.SPAWN_BEAM, 1, 3)
+           , (main.SPAWN_RADIAL, 3, 7)
+           , (main.SPAWN_STUPID, 12, 10)
+           , (main.SPAWN_SWEEPER, 14, 16)
+           ]
+
+  return size, size, tiles, spawns
+
+def bench_rooms():
+  import main
+  main.THREADED_LIGHTING = False
+
+  buff = pygame.Surface((main.WIDTH, main.HEIGHT))
+  frames = 300
+
+  print "rooms, %d frames walking right, ms" % frames
+  print "%-10s %8s %8s %8s" % ("size", "tiles", "build", "frame")
+
+  for size in (20, 40, 80, 160):
+    main.Map.level = level.Rooms({ (0, 0): big_room(size) })
+    main.Map.baked = {}
+
+    start = timeit.default_timer()
+    manager = main.new_world((0, 0))
+    built = timeit.default_timer() - start
+
+    main.UpKeys.add_key(pygame.K_RIGHT)
+
+    start = timeit.default_timer()
+    for i in range(frames):
+      main.Tick.inc()
+      main.UpKeys.flush()
+      main.step(manager, buff)
+    per_frame = (timeit.default_timer() - start) / frames
+
+    main.UpKeys.release_key(pygame.K_RIGHT)
+    main.end_world(manager)
+    print "%-10s %8d %8.1f %8.3f" % ("%dx%d" % (size, size), size * size, built * 1000, per_frame * 1000)
+
+  main.Map.level = None
+  main.Map.baked = None
+
+# Runs the game in a fresh python, and prints how long it took, from when
+# the parent started it, to get the first frame on the screen.
+FIRST_FRAME = """
+import os, sys, timeit
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+started = float(sys.argv[1])
+import main
+
+def present(self, rects=None):
+  sys.stdout.write("%f\\n" % ((timeit.default_timer() - started) * 1000))
+  sys.stdout.flush()
+  os._exit(0)
+
+main.Presenter.present = present
+main.start(["--headless"])
+"""
+
+def in_fresh_python(code, *args):
+  """ Run code in a new python, one that hasn't imported anything yet. """
+  return subprocess.check_output([sys.executable, "-c", code] + list(args))
+
+def bench_startup():
+  print "startup, best of 3, ms"
+
+  # Each import only costs anything the first time, so every one gets a
+  # python of its own.
+  for module in ("main", "spritesheet", "wordwrap"):
+    code = "import timeit; start = timeit.default_timer(); import %s; print (timeit.default_timer() - start) * 1000" % module
+    times = [float(in_fresh_python(code).split()[-1]) for i in range(3)]
+    print "%-24s %8.1f" % ("import %s" % module, min(times))
+
+  times = [float(in_fresh_python(FIRST_FRAME, repr(timeit.default_timer())).split()[-1]) for i in range(3)]
+  print "%-24s %8.1f" % ("first frame", min(times))
+
+BENCHMARKS = { "blur": bench_blur
+             , "rooms": bench_rooms
+             , "startup": bench_startup
+             }
+
+if __name__ == "__main__":
+  pygame.init()
+  pygame.display.set_mode((1, 1))
+
+  names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+  for name in names:
+    BENCHMARKS[name]()
+    print
@@ -0,0 +1,109 @@
+"""
+Blurring for the lightmap and the particles.
+
+The cheap way to blur in pygame is to shrink a surface and blow it back up
+again with smoothscale. Doing that allocates two new surfaces every time,
+which adds up when the lightmap is blurred twice per relight. A Blur keeps
+its intermediate surfaces around and reuses them instead.
+"""
+
+import pygame
+
+# Quality levels, from fastest to prettiest.
+FAST = 0      # shrink and grow with nearest neighbour scaling. Blocky.
+SMOOTH = 1    # shrink and grow with smoothscale. What the game always did.
+GAUSSIAN = 2  # a proper separable blur, done with numpy. Small surfaces only.
+
+def smoothscale_blur(surface, amt):
+  """ The original, allocate-everything-every-time blur. """
+  if amt < 1.0: raise ValueError("Arg 'amt' must be greater than 1.0, passed in value is %s"%amt)
+
+  scale = 1.0/float(amt)
+  surf_size = surface.get_size()
+  scale_size = (int(surf_size[0]*scale), int(surf_size[1]*scale))
+  surf = pygame.transform.smoothscale(surface, scale_size)
+  surf = pygame.transform.smoothscale(surf, surf_size)
+  return surf
+
+def box_blur(a, radius, axis):
+  """ Average every element of a with the radius elements either side of it
+  along axis. Edges are clamped. """
+  import numpy
+
+  width = radius * 2 + 1
+
+  pad = [(0, 0)] * a.ndim
+  pad[axis] = (radius + 1, radius)
+  summed = numpy.cumsum(numpy.pad(a, pad, mode="edge"), axis=axis)
+
+  ahead = [slice(None)] * a.ndim
+  behind = [slice(None)] * a.ndim
+  ahead[axis] = slice(width, None)
+  behind[axis] = slice(0, -width)
+
+  return (summed[tuple(ahead)] - summed[tuple(behind)]) / width
+
+class Blur(object):
+  """ Blurs surfaces of any size, reusing the same scratch surfaces for every
+  blur of the same size. The surface blur() returns belongs to the Blur, and
+  gets overwritten by the next blur of that size unless you pass in dest.
+
+  Blurs aren't thread safe. Give each thread its own. """
+  def __init__(self, quality=SMOOTH):
+    self.quality = quality
+    self.buffers = {}
+
+  def buffer(self, name, size, like):
+    key = (name, size, like.get_flags(), like.get_bitsize())
+
+    if key not in self.buffers:
+      self.buffers[key] = pygame.Surface(size, like.get_flags(), like)
+
+    return self.buffers[key]
+
+  def blur(self, surface, amt, dest=None):
+    if amt < 1.0: raise ValueError("Arg 'amt' must be greater than 1.0, passed in value is %s"%amt)
+
+    size = surface.get_size()
+    if dest is None:
+      dest = self.buffer("out", size, surface)
+
+    if self.quality == GAUSSIAN:
+      return self.gaussian(surface, amt, dest)
+
+    scale = 1.0/float(amt)
+    small_size = (int(size[0]*scale), int(size[1]*scale))
+    small = self.buffer("small", small_size, surface)
+
+    if self.quality == FAST:
+      pygame.transform.scale(surface, small_size, small)
+      pygame.transform.scale(small, size, dest)
+    else:
+      pygame.transform.smoothscale(surface, small_size, small)
+      pygame.transform.smoothscale(small, size, dest)
+
+    return dest
+
+  def gaussian(self, surface, amt, dest):
+    # Only GAUSSIAN needs numpy, so only GAUSSIAN pays for importing it.
+    import numpy
+
+    # Three box blurs in a row are close enough to a gaussian.
+    radius = max(1, int(amt / 2))
+
+    rgb = pygame.surfarray.array3d(surface).astype(numpy.float32)
+    for i in range(3):
+      rgb = box_blur(box_blur(rgb, radius, 0), radius, 1)
+    pygame.surfarray.blit_array(dest, rgb.astype(numpy.uint8))
+
+    if surface.get_flags() & pygame.SRCALPHA:
+      alpha = pygame.surfarray.array_alpha(surface).astype(numpy.float32)
+      for i in range(3):
+        alpha = box_blur(box_blur(alpha, radius, 0), radius, 1)
+
+      # pixels_alpha locks dest until the view goes away.
+      view = pygame.surfarray.pixels_alpha(dest)
+      view[:] = alpha.astype(numpy.uint8)
+      del view
+
+    return dest
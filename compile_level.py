@@ -0,0 +1,40 @@
+"""
+Compiles every room in laderp.bmp into laderp.lvl, so the game never has to
+decode the map image. See level.py for the format.
+
+Re-run this whenever laderp.bmp or main.compile_room changes. (The game
+ignores laderp.lvl if it was compiled from some other laderp.bmp; the md5
+of the one it came from is in its header.)
+
+Usage:
+    python compile_level.py
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import level
+import main
+
+if __name__ == "__main__":
+  world = pygame.image.load(main.MAP_FILE)
+  width, height = world.get_size()
+  size = main.MAP_SIZE_TILES
+
+  rooms = {}
+  for mx in range(width // size):
+    for my in range(height // size):
+      mapdata = world.subsurface((mx * size, my * size, size, size))
+
+      try:
+        codes = main.room_codes(mapdata)
+      except KeyError:
+        # Colors that don't mean anything. Not a real room.
+        continue
+
+      rooms[(mx, my)] = main.compile_room(codes)
+
+  level.write_level(main.LEVEL_FILE, rooms, main.map_digest())
+
+  print "Compiled %d of %d rooms into %s (%d bytes)." % (len(rooms), (width // size) * (height // size), main.LEVEL_FILE, os.path.getsize(main.LEVEL_FILE))
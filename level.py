@@ -0,0 +1,102 @@
+"""
+The compiled level format, made by compile_level.py from laderp.bmp.
+
+Reading a room straight out of laderp.bmp means decoding the image and
+looking up the color of every pixel. A compiled level has already done all
+of that: each room is a grid of tile kinds and a list of things to spawn,
+so loading one is a couple of slices of a memory mapped file.
+
+The layout, all little endian:
+
+    header   magic "LD23LVL3", md5 of what it was compiled from (16 bytes),
+             number of rooms
+    index    per room: map x, map y, width and height in tiles, offset of
+             its data, number of spawns
+    rooms    per room: a byte per tile (the tile kind, column by column),
+             then five bytes per spawn (spawn kind, tile x, tile y)
+
+What the tile and spawn kinds mean is up to main.py, and so is deciding
+whether the md5 in the header means the level is out of date.
+"""
+
+import mmap
+import struct
+
+MAGIC = "LD23LVL3"
+HEADER = struct.Struct("<8s16sI")
+INDEX = struct.Struct("<hhHHII")
+SPAWN = struct.Struct("<BHH")
+
+def write_level(path, rooms, source):
+  """ rooms is (map x, map y) -> (width, height, tiles, spawns), where tiles
+  is width * height tile kinds, column by column, and spawns is a list of
+  (kind, x, y). source is the md5 digest of whatever they came from. """
+  order = sorted(rooms.keys())
+
+  offset = HEADER.size + INDEX.size * len(order)
+  index = []
+  data = []
+  for room in order:
+    width, height, tiles, spawns = rooms[room]
+    if len(tiles) != width * height: raise ValueError("Room %s has %d tiles, not %d" % (room, len(tiles), width * height))
+
+    body = str(bytearray(tiles)) + "".join(SPAWN.pack(*spawn) for spawn in spawns)
+    index.append(INDEX.pack(room[0], room[1], width, height, offset, len(spawns)))
+    data.append(body)
+    offset += len(body)
+
+  f = open(path, "wb")
+  f.write(HEADER.pack(MAGIC, source, len(order)))
+  f.write("".join(index))
+  f.write("".join(data))
+  f.close()
+
+class Level(object):
+  """ A compiled level, mapped into memory. Nothing is read until a room is
+  asked for. """
+  def __init__(self, path):
+    f = open(path, "rb")
+    self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+
+    magic, self.source, count = HEADER.unpack_from(self.data, 0)
+    if magic != MAGIC: raise ValueError("%s isn't a compiled level" % path)
+
+    self.index = {}
+    for i in range(count):
+      mx, my, width, height, offset, spawns = INDEX.unpack_from(self.data, HEADER.size + INDEX.size * i)
+      self.index[(mx, my)] = (width, height, offset, spawns)
+
+  def __contains__(self, room):
+    return room in self.index
+
+  def room(self, room):
+    """ (width, height, tiles, spawns) for the room, as write_level() was
+    given them. """
+    width, height, offset, count = self.index[room]
+    area = width * height
+
+    tiles = bytearray(self.data[offset:offset + area])
+    spawns = [SPAWN.unpack_from(self.data, offset + area + SPAWN.size * i) for i in range(count)]
+
+    return width, height, tiles, spawns
+
+  def preload(self):
+    """ Read the whole file now, rather than a page at a time as rooms get
+    asked for. """
+    self.data[:]
+
+  def close(self):
+    self.data.close()
+
+class Rooms(object):
+  """ A level that only exists in memory, for rooms that were made up on the
+  spot rather than compiled. Same rooms as write_level() takes. """
+  def __init__(self, rooms):
+    self.rooms = rooms
+
+  def __contains__(self, room):
+    return room in self.rooms
+
+  def room(self, room):
+    return self.rooms[room]
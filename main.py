@@ -1,9 +1,14 @@
 from __future__ import division
-import sys, pygame, spritesheet, wordwrap
+import sys, os, pygame, spritesheet, wordwrap, blur, audio, level, assets
 import random
-import numpy
+import struct
+import time
+import argparse
+import threading
+import Queue
 import math
-import cProfile
+import hashlib
+import cPickle as pickle
 from wordwrap import render_textrect
 
 WIDTH = HEIGHT = 300
@@ -11,13 +16,20 @@ TILE_SIZE = 20
 VISIBLE_MAP_SIZE = 10
 CHAR_XY = WIDTH / 2
 GRAVITY = 1
+# The size of a room in laderp.bmp. Rooms from elsewhere can be any size.
 MAP_SIZE_TILES = 20
-MAP_SIZE_PIXELS = MAP_SIZE_TILES * TILE_SIZE
+
+# Rooms are lit a chunk at a time, and only the chunks within LIGHT_REACH
+# pixels of the character.
+CHUNK_TILES = 10
+CHUNK_PIXELS = CHUNK_TILES * TILE_SIZE
+LIGHT_REACH = WIDTH
 NOT_DARK = 0
 
 #aesthestics
 
 JIGGLE_LENGTH = 50
+ANIM_TICKS = 8
 JIGG_RANGE = 3
 
 ZOOM_SPEED = 20
@@ -25,8 +37,6 @@ ZOOM_SPEED = 20
 MIN_LIGHT = 180
 CAM_LAG = 20
 
-CROSSFADE_SPEED = 0.03
-
 #gameplay
 
 MAX_HEALTH_INC = 3
@@ -50,9 +60,35 @@ BAR_DEPTH = 200
 
 # sfx
 
-land_sound  = None
-jump_sound  = None
-shoot_sound = None
+sfx = audio.SoundEffects()
+
+# name: (file, volume, max voices, priority)
+SOUNDS = { "land":  ("land.wav",  1.0, 1, 2)
+         , "jump":  ("jump.wav",  1.0, 1, 2)
+         , "shoot": ("shoot.wav", 0.2, 3, 1)
+         }
+
+SOUNDTRACK_FILES = ("soundtrack-normal.ogg", "soundtrack-dark.ogg")
+
+# animation
+
+# name: (sheet, frames, ticks per frame, loops)
+CLIPS = { "walk-left":        ("tiles.png", [(0, 4), (1, 4), (2, 4), (3, 4)], 8, True)
+        , "walk-right":       ("tiles.png", [(0, 3), (1, 3), (2, 3), (3, 3)], 8, True)
+        , "sentry":           ("tiles.png", [(7, 1), (8, 1)], 20, True)
+        , "sweeper-waiting":  ("tiles.png", [(9, 1)], ANIM_TICKS, False)
+        , "sweeper-charging": ("tiles.png", [(9, 0)], ANIM_TICKS, False)
+        , "bullet-pop":       ("tiles.png", [(3, 1), (3, 2)], 5, False)
+        , "lock-open":        ("tiles.png", [(0, 0)], ANIM_TICKS, False)
+        , "lock-shut":        ("tiles.png", [(7, 2)], ANIM_TICKS, False)
+        , "switch-down":      ("tiles.png", [(5, 3)], ANIM_TICKS, False)
+        , "switch-up":        ("tiles.png", [(4, 3)], ANIM_TICKS, False)
+        }
+
+# text
+
+FONT_FILE = "nokiafc22.ttf"
+TEXT_SIZE = 12
 
 #hax
 
@@ -62,7 +98,29 @@ going_insane = False
 
 DEBUG = False
 
-screen = pygame.display.set_mode((WIDTH * 2, HEIGHT * 2))
+QUICKSAVE_FILE = "quicksave.sav"
+
+# Light rooms on a background thread. The lighting everybody sees is then
+# always exactly one relight old.
+THREADED_LIGHTING = True
+
+# How nicely to blur the lightmap. See blur.py.
+LIGHT_BLUR_QUALITY = blur.SMOOTH
+
+# command line options, see parse_args()
+
+HEADLESS = False
+NO_RENDER = False
+SCALE = 2
+USE_SCALED = False
+DIRTY_RECTS = False
+RECORD_FILE = None
+REPLAY_FILE = None
+TRACE_FILE = None
+PROFILE_FILE = None
+
+screen = None
+presenter = None
 
 def get_uid():
   get_uid.uid += 1
@@ -75,28 +133,149 @@ def darken(surface, value):
     dark.set_alpha(value, pygame.RLEACCEL)
     surface.blit(dark, (0, 0))
 
-def blur_surf(surface, amt):
-    if amt < 1.0: raise ValueError("Arg 'amt' must be greater than 1.0, passed in value is %s"%amt)
-
-    scale = 1.0/float(amt)
-    surf_size = surface.get_size()
-    scale_size = (int(surf_size[0]*scale), int(surf_size[1]*scale))
-    surf = pygame.transform.smoothscale(surface, scale_size)
-    surf = pygame.transform.smoothscale(surf, surf_size)
-    return surf
 
+class Timer(object):
+  def __init__(self, when, callback, period=None):
+    self.when = when
+    self.callback = callback
+    self.period = period
 
 class Tick:
+  """ The game clock. It also keeps a two level timer wheel, so sleeping
+  entities can ask to be woken at some later tick instead of checking
+  Tick.get(n) every tick themselves, and so every-n-ticks cadences can be
+  spread over different ticks (see due()).
+
+  The inner wheel has a slot per tick of the current round of WHEEL_SIZE
+  ticks, and the outer wheel a slot per round. Each tick only runs the one
+  inner slot that's due; at the start of each round that round's outer slot
+  is spread over the inner wheel. Timers further off than the outer wheel
+  reaches wait in later. Callbacks run from inc(), before anything updates. """
   tick = 0
 
+  WHEEL_SIZE = 64
+  inner = [[] for i in range(WHEEL_SIZE)]
+  outer = [[] for i in range(WHEEL_SIZE)]
+  later = []
+
+  # (period, phase) -> the last tick its every() timer went off.
+  cadences = {}
+
   @staticmethod
   def inc():
     Tick.tick += 1
+    now = Tick.tick
+    size = Tick.WHEEL_SIZE
+
+    if now % (size * size) == 0:
+      later = Tick.later
+      Tick.later = []
+      for timer in later:
+        Tick.schedule(timer)
+
+    if now % size == 0:
+      slot = (now // size) % size
+      timers = Tick.outer[slot]
+      Tick.outer[slot] = []
+      for timer in timers:
+        Tick.inner[timer.when % size].append(timer)
+
+    slot = now % size
+    due = Tick.inner[slot]
+    Tick.inner[slot] = []
+
+    for timer in due:
+      timer.callback()
+
+      if timer.period is not None:
+        timer.when += timer.period
+        Tick.schedule(timer)
 
   @staticmethod
   def get(prob=1):
     return (Tick.tick % prob == 0)
 
+  @staticmethod
+  def schedule(timer):
+    size = Tick.WHEEL_SIZE
+    now_round = Tick.tick // size
+    when_round = timer.when // size
+
+    if when_round == now_round:
+      Tick.inner[timer.when % size].append(timer)
+    elif when_round // size == now_round // size:
+      Tick.outer[when_round % size].append(timer)
+    else:
+      Tick.later.append(timer)
+
+  @staticmethod
+  def at(when, callback):
+    """ Call callback once, on tick when. """
+    if when <= Tick.tick: raise ValueError("Tick %d has already happened." % when)
+
+    timer = Timer(when, callback)
+    Tick.schedule(timer)
+    return timer
+
+  @staticmethod
+  def every(period, callback, phase=0):
+    """ Call callback on every tick that's phase ticks past a multiple of
+    period. """
+    timer = Timer(Tick.next(period, phase), callback, period)
+    Tick.schedule(timer)
+    return timer
+
+  @staticmethod
+  def next(period, phase=0):
+    """ The next tick after this one that's phase ticks past a multiple of
+    period. """
+    when = Tick.tick - Tick.tick % period + phase % period
+    if when <= Tick.tick:
+      when += period
+    return when
+
+  @staticmethod
+  def due(period, phase=0):
+    """ Like Tick.get(period), but phase ticks later. Things that pass their
+    uid as the phase take their turns on different ticks, rather than all
+    on the same one. Each (period, phase) gets one every() timer, made the
+    first time anybody asks. """
+    key = (period, phase % period)
+    if key in Tick.cadences:
+      return Tick.cadences[key] == Tick.tick
+
+    def went_off():
+      Tick.cadences[key] = Tick.tick
+
+    Tick.cadences[key] = Tick.tick if Tick.tick % period == key[1] else None
+    Tick.every(period, went_off, phase)
+    return Tick.cadences[key] == Tick.tick
+
+  @staticmethod
+  def clear():
+    """ Forget every timer. They're all for entities of the world that's
+    being thrown away. """
+    size = Tick.WHEEL_SIZE
+    Tick.inner = [[] for i in range(size)]
+    Tick.outer = [[] for i in range(size)]
+    Tick.later = []
+    Tick.cadences = {}
+
+class Scheduler:
+  """ Sleeping entities that were just given something to do, or whose
+  wake up timer went off. The next Entities.updating() picks them up. """
+  woken = []
+
+  @staticmethod
+  def wake(entity):
+    Scheduler.woken.append(entity)
+
+  @staticmethod
+  def take():
+    woken = Scheduler.woken
+    Scheduler.woken = []
+    return woken
+
 class TileSheet:
   """ Memoize all the sheets so we don't load in 1 sheet like 50 times and
   squander resources. This is a singleton, which is generally frowned upon,
@@ -120,6 +299,65 @@ class TileSheet:
       TileSheet.add(sheet)
     return TileSheet.sheets[sheet][x][y]
 
+class Fonts:
+  """ FONT_FILE at every size anybody asked for, loaded once. Like TileSheet,
+  but for text. """
+  fonts = {}
+
+  @staticmethod
+  def add(size):
+    if size in Fonts.fonts:
+      return
+
+    Fonts.fonts[size] = pygame.font.Font(FONT_FILE, size)
+
+  @staticmethod
+  def get(size):
+    if size not in Fonts.fonts:
+      Fonts.add(size)
+    return Fonts.fonts[size]
+
+class Clip(object):
+  """ A run of frames, already cut out of their sheet, each shown for ticks
+  ticks. Clips are shared by everybody playing them, so nothing changes
+  them; where an entity is up to is its own business. """
+  def __init__(self, frames, ticks, loop):
+    self.frames = frames
+    self.ticks = ticks
+    self.loop = loop
+
+  def after(self, frame):
+    """ The frame that comes after frame: back to the first one if the clip
+    loops, None if it's over. """
+    frame += 1
+    if frame < len(self.frames):
+      return frame
+    return 0 if self.loop else None
+
+class Clips:
+  """ Every clip in CLIPS, by name, made once. Like TileSheet, but for
+  animations. """
+  clips = {}
+
+  @staticmethod
+  def add(name):
+    if name in Clips.clips:
+      return
+
+    sheet, frames, ticks, loop = CLIPS[name]
+    Clips.clips[name] = Clip(tuple(TileSheet.get(sheet, x, y) for x, y in frames), ticks, loop)
+
+  @staticmethod
+  def load():
+    for name in CLIPS:
+      Clips.add(name)
+
+  @staticmethod
+  def get(name):
+    if name not in Clips.clips:
+      Clips.add(name)
+    return Clips.clips[name]
+
 #TODO: Entity should extend Rect.
 
 class Rect(object):
@@ -137,6 +375,10 @@ class Rect(object):
            self.y <= point[1] <= self.y + self.height
 
 class Entity(object):
+  # Entities that sleep only get update() called while busy(). Anything that
+  # gives them something to do wakes them back up.
+  sleeps = False
+
   def __init__(self, x, y, groups, src_x = -1, src_y = -1, src_file = ""):
     self.x = x
     self.y = y
@@ -158,10 +400,40 @@ class Entity(object):
     self.fade_out = False
     self.fade_in = False
     self.alpha = 255
-    self.anim = []
-
-  def animate(self, frames):
-    self.anim = frames
+    self.clip = None
+    self.frame = 0
+
+  def play(self, name):
+    """ Start the clip called name. Its first frame shows the next time
+    Tick.due(its ticks, uid) is, and the last one stays up after it's
+    over. """
+    self.clip = Clips.get(name)
+    self.frame = 0
+    self.wake()
+
+  def step(self):
+    """ Show the next frame of the clip, if it's time to. """
+    clip = self.clip
+    if clip is not None and Tick.due(clip.ticks, self.uid):
+      self.img = clip.frames[self.frame]
+      self.frame = clip.after(self.frame)
+      if self.frame is None:
+        self.clip = None
+        self.frame = 0
+
+  def wake(self):
+    if self.sleeps: Scheduler.wake(self)
+
+  def busy(self):
+    """ Whether Entity.update has anything to do this tick. """
+    return (self.clip is not None and Tick.due(self.clip.ticks, self.uid)) or self.jiggling > 0 or self.flashing > 0 or \
+           (self.fade_out and self.alpha > 0) or (self.fade_in and self.alpha > 0)
+
+  def wakes_at(self):
+    """ When a sleeper that isn't busy() next will be, if ever. """
+    if self.clip is not None:
+      return Tick.next(self.clip.ticks, self.uid)
+    return None
 
   def push(self, direction, entities):
     assert "pushable" in self.groups
@@ -179,28 +451,30 @@ class Entity(object):
     new_x = self.x + direction[0] * TILE_SIZE
     new_y = self.y + direction[1] * TILE_SIZE
 
-    if entities.any("wall", lambda e: e.x == new_x and e.y == new_y): return
+    if len(m.walls(entities, new_x, new_y, new_x, new_y, lambda e: e.x == new_x and e.y == new_y)) > 0: return
     self.move(new_x, new_y, entities)
 
   def move(self, x, y, entities):
     self.x = x
     self.y = y
+    entities.report_move(self)
 
     if "beamlight" in self.groups: self.beamtick = BEAM_START_LENGTH
 
     if "persistent" not in self.groups: return
 
     went_offscreen = False
+    width, height = entities.one("map").pixel_size()
 
     if self.x <= 0: 
-      self.x = MAP_SIZE_PIXELS - TILE_SIZE * 2
+      self.x = width - TILE_SIZE * 2
       self.restore_map_xy = (self.restore_map_xy[0] - 1, self.restore_map_xy[1])
       went_offscreen = True
-    elif self.x >= MAP_SIZE_PIXELS:
+    elif self.x >= width:
       self.x = TILE_SIZE * 2
       self.restore_map_xy = (self.restore_map_xy[0] + 1, self.restore_map_xy[1])
       went_offscreen = True
-    elif self.y >= MAP_SIZE_PIXELS:
+    elif self.y >= height:
       self.y = TILE_SIZE * 2
       self.restore_map_xy = (self.restore_map_xy[0], self.restore_map_xy[1] + 1)
       went_offscreen = True
@@ -218,6 +492,7 @@ class Entity(object):
   def zoom(self, position, room, entities):
     self.x = position[0]
     self.y = position[1]
+    entities.report_move(self)
 
     m = entities.one("map")
     if m.get_mapxy() != room:
@@ -226,10 +501,11 @@ class Entity(object):
   def jiggle(self):
     self.jiggling = JIGGLE_LENGTH
     self.old_xy = (self.x, self.y)
+    self.wake()
 
   def collides_with_wall(self, entities):
     nr = self.nicer_rect()
-    return entities.any("wall", lambda x: x.touches_rect(nr))
+    return len(entities.one("map").walls(entities, nr.x, nr.y, nr.x + nr.size, nr.y + nr.size, lambda x: x.touches_rect(nr))) > 0
 
   def nicer_rect(self):
     return Rect(self.x + 1, self.y + 1, self.size - 2)
@@ -278,11 +554,13 @@ class Entity(object):
   def fadein(self):
     self.alpha = 0
     self.fade_in = True
+    self.wake()
 
   def fadeout(self):
     if self.visible and self.alpha == 255:
       self.alpha = 255
       self.fade_out = True
+      self.wake()
 
   # How high/low this object is
   # Big = on top.
@@ -300,6 +578,7 @@ class Entity(object):
 
   def flash(self):
     self.flashing = 30
+    self.wake()
 
   def render(self, screen, dx=0, dy=0):
     if not self.visible: return
@@ -309,28 +588,21 @@ class Entity(object):
 
     screen.blit(self.img, self.rect)
 
-  def update(self, entities):
-    assert(not self.fade_out or not self.fade_in)
-
-    if "switch" in self.groups:
-      activated = False
+  # For dirty rect rendering. An entity only gets redrawn if one of these
+  # changed since the last frame.
 
-      for e in entities.get("switchpusher"):
-        if e.touches_rect(self):
-          self.activate(entities)
-          activated = True
+  def screen_rect(self, dx=0, dy=0):
+    """ Where render() draws. """
+    return pygame.Rect(self.x + dx, self.y + dy, self.img.get_width(), self.img.get_height())
 
-          #save position of the block that's pushing the switch.
-          if "persistent" in e.groups:
-            # This hack prevents an unwinnable situation in room (3, 1).
-            if not (e.x == 240 and e.y ==  360 and e.restore_map_xy == (3, 1)):
-              e.restore_xy = (e.x, e.y)
+  def appearance(self):
+    """ Everything other than where it is that changes what render() draws. """
+    return (self.img, bool(self.visible))
 
-      if not activated:
-        self.deactivate(entities)
+  def update(self, entities):
+    assert(not self.fade_out or not self.fade_in)
 
-    if len(self.anim) > 0 and Tick.get(8):
-      self.img = TileSheet.get("tiles.png", *self.anim.pop(0))
+    self.step()
 
     if self.fade_out and self.alpha > 0:
       self.alpha -= 5
@@ -351,11 +623,17 @@ class Entity(object):
     return True
 
 class Particles(Entity):
+  """ Draws onto a surface only as big as the particles need, however big
+  the room is. With no particles, there's nothing to draw at all. """
   def __init__(self):
     super(Particles, self).__init__(0, 0, ["renderable", "updateable", "relative", "particles"])
+    self.blur = blur.Blur()
+    self.surf = None
+    self.bounds = pygame.Rect(0, 0, 0, 0)
 
   def reinitialize(self, entities, particle_sources):
-    self.surf = pygame.Surface((MAP_SIZE_PIXELS, MAP_SIZE_PIXELS), pygame.SRCALPHA) #TODO: make actual map size.
+    self.surf = None
+    self.bounds = pygame.Rect(0, 0, 0, 0)
     self.particles = []
     self.beams = []
     self.particle_sources = particle_sources
@@ -365,7 +643,6 @@ class Particles(Entity):
     return
 
     self.tick += 1
-    self.surf = pygame.Surface((MAP_SIZE_PIXELS, MAP_SIZE_PIXELS), pygame.SRCALPHA) #TODO: make actual map size.
 
     for source in self.particle_sources:
       if random.random() > .8:
@@ -380,16 +657,35 @@ class Particles(Entity):
 
     for p in self.particles:
       p.update()
-      p.render(self.surf)
 
-    self.surf = blur_surf(self.surf, 5.0)
+    if len(self.particles) == 0:
+      self.surf = None
+      self.bounds = pygame.Rect(0, 0, 0, 0)
+      return
+
+    # Room for the blur to spread out.
+    rects = [pygame.Rect(p.x, p.y, TILE_SIZE, TILE_SIZE) for p in self.particles]
+    self.bounds = rects[0].unionall(rects[1:]).inflate(TILE_SIZE * 2, TILE_SIZE * 2)
+
+    surf = pygame.Surface(self.bounds.size, pygame.SRCALPHA)
+    for p in self.particles:
+      p.render(surf, -self.bounds.x, -self.bounds.y)
+
+    self.surf = self.blur.blur(surf, 5.0)
 
   def depth(self):
     return PARTICLE_DEPTH
 
   def render(self, screen, dx, dy):
-    #screen.blit(self.surf, self.surf.get_rect().topleft)
-    screen.blit(self.surf, (dx, dy))
+    if self.surf is None: return
+
+    screen.blit(self.surf, self.bounds.move(dx, dy))
+
+  def screen_rect(self, dx=0, dy=0):
+    return self.bounds.move(dx, dy)
+
+  def appearance(self):
+    return self.surf
 
 class Particle(Entity):
   def __init__(self, x, y):
@@ -417,98 +713,410 @@ class Particle(Entity):
     self.y -= self.speed
     self.x = self.x_init + math.sin(self.sin_offset + self.sin_speed * self.tick/10) * self.sin_width
 
-  def render(self, screen):
-    screen.blit(self.trans_img, (self.x, self.y))
+  def render(self, screen, dx=0, dy=0):
+    screen.blit(self.trans_img, (self.x + dx, self.y + dy))
 
-class LightBeam(Entity):
-  def __init__(self, x, y):
-    super(LightBeam, self).__init__(x, y, [], 8, 0, "tiles.png")
-    self.img.set_alpha(50)
+def in_room(x, y, opaque):
+  """ Whether pixel (x, y) is inside the room opaque is the opacity() of. """
+  return 0 <= x < len(opaque) * TILE_SIZE and 0 <= y < len(opaque[0]) * TILE_SIZE
 
-  def render(self, screen):
-    super(LightBeam, self).render(screen)
+def trace_beam(x, y, direction, opaque, reflectors):
+  """ Every tile a beam starting at (x, y) passes through if it were infinitely
+  long, as a list of (absolute position, tile position). """
+  path = []
 
-class LightSpot(Entity):
-  def __init__(self, x, y, intensity):
-    if intensity > MIN_LIGHT: intensity = MIN_LIGHT
+  pos_abs = [x, y]
+  pos_rel = [int(x / TILE_SIZE), int(y / TILE_SIZE)]
+  cur_dir = direction
+  seen = set()
+
+  while in_room(pos_abs[0], pos_abs[1], opaque) and not opaque[pos_rel[0]][pos_rel[1]]:
+    # Reflectors can send a beam around in circles forever.
+    state = (pos_abs[0], pos_abs[1], tuple(cur_dir))
+    if state in seen: break
+    seen.add(state)
+
+    path.append(((pos_abs[0], pos_abs[1]), (pos_rel[0], pos_rel[1])))
+
+    if cur_dir[0] == 0 and cur_dir[1] == 0: break
+
+    if (pos_abs[0], pos_abs[1]) in reflectors:
+      cur_dir = Reflector.reflect(cur_dir)
+
+    pos_abs[0] += cur_dir[0] * TILE_SIZE
+    pos_abs[1] += cur_dir[1] * TILE_SIZE
+
+    pos_rel[0] += cur_dir[0]
+    pos_rel[1] += cur_dir[1]
+
+  return path
+
+def falloff_kernel(intensity, falloff):
+  """ The light a single beam tile spills onto the tiles around it, as a list
+  of (dx, dy, delta). It's diamond shaped, so we skip the corners (and
+  anything else that would add 0). """
+  key = (intensity, falloff)
+  if key in falloff_kernel.cache: return falloff_kernel.cache[key]
+
+  radius = int(math.ceil(- intensity / falloff))
+  kernel = []
+
+  for dx in range(-radius, radius + 1):
+    for dy in range(-radius, radius + 1):
+      point_intensity = -max(0, 255 - (abs(dx) + abs(dy)) * falloff)
+      if point_intensity != 0:
+        kernel.append((dx, dy, point_intensity))
+
+  falloff_kernel.cache[key] = kernel
+  return kernel
+falloff_kernel.cache = {}
+
+# Light deltas are sparse, {(x, y): delta}, so a light costs the same however
+# big the room it's in is.
+
+def beam_light_deltas(path, intensity, falloff, opaque):
+  width, height = len(opaque), len(opaque[0])
+  deltas = {}
+  kernel = falloff_kernel(intensity, falloff)
+
+  for pos_abs, (px, py) in path:
+    # bugginess of this line approaches 1...
+    deltas[(px, py)] = intensity
+
+    # radial lighting
+    for dx, dy, point_intensity in kernel:
+      x = px + dx
+      y = py + dy
+      if 0 <= x < width and 0 <= y < height:
+        deltas[(x, y)] = deltas.get((x, y), 0) + point_intensity
+
+  return deltas
+
+def radial_light_deltas(x0, y0, intensity, opaque):
+  radius = 500
+  pts = []
+  deltas = {}
+
+  for x in range(x0 - radius, x0 + radius + 1, TILE_SIZE):
+    for y in range(y0 - radius, y0 + radius + 1, TILE_SIZE):
+      if x == x0 - radius or x == x0 + radius or y == y0 - radius or y == y0 + radius:
+        pts.append((x, y))
+
+  for x, y in pts:
+    pt = [x0, y0]
+
+    #raycast to (x, y) and light up everything along the way.
+    dx = (x - x0) * TILE_SIZE / radius
+    dy = (y - y0) * TILE_SIZE / radius
+
+    for i in range(radius):
+      if not in_room(pt[0], pt[1], opaque): break
+      if opaque[int(pt[0] / 20)][int(pt[1] / 20)]: break
+      deltas[(int(pt[0] / 20), int(pt[1] / 20))] = intensity #* (1 - (i + 20) / (radius + 20))
+      pt[0] = pt[0] + dx
+      pt[1] = pt[1] + dy
+
+  return deltas
+
+class LightingJob(object):
+  """ A copy of everything that decides how the room is lit: the light
+  sources, where the reflectors are and which tiles are opaque. None of it
+  points back into the game, so run() is safe to call off the main thread
+  while the game carries on.
+
+  Only the tiles in window (a Rect, in tiles) get lit. Everything else is
+  left dark. """
+  def __init__(self, layout, opaque, reflectors, sources, cache, window):
+    self.layout = layout
+    self.opaque = opaque
+    self.reflectors = reflectors
+    self.sources = sources
+    self.cache = cache
+    self.window = window
+    self.light = None
+    self.spots = None
+    self.target = None
+    self.baked = None
 
-    self.x = x
-    self.y = y
+  @staticmethod
+  def of(entities, m, light):
+    sources = [source.light_state() for source in entities.get("light-source")]
+    ch = entities.one("character")
+    window = m.lit_window(ch.x, ch.y)
+
+    job = LightingJob((m.get_mapxy(), m.layout_version), m.opacity(), frozenset(m.reflectors.keys()), sources, light.cache, window)
+    job.light = light
+    job.spots = light.scratch(window.width * TILE_SIZE, window.height * TILE_SIZE)
+    job.target = light.next_lightmap(job.spots.get_size())
+
+    if window.size == (m.width, m.height):
+      job.baked = Map.baked_lighting(m.get_mapxy(), job)
+    return job
+
+  def source_deltas(self, source):
+    """ Returns (deltas, beam positions) for one source. Beam paths and radial
+    deltas are cached on the Light until the source or the layout changes. """
+    uid, light_type, x, y, direction, beamtick, intensity, falloff = source
+    cache = self.cache
+    key = (x, y, direction, self.layout)
+
+    if light_type == LightSource.RADIAL:
+      if uid not in cache or cache[uid][0] != key:
+        cache[uid] = (key, radial_light_deltas(x, y, intensity, self.opaque))
+      return cache[uid][1], []
+
+    if uid not in cache or cache[uid][0] != key:
+      cache[uid] = (key, trace_beam(x, y, direction, self.opaque, self.reflectors), None, None)
 
-    self.s = pygame.Surface((TILE_SIZE,TILE_SIZE), pygame.SRCALPHA)  # the size of your rect
-    self.s.fill((0, 0, 0, intensity))
+    key, path, deltas_len, deltas = cache[uid]
+    path = path[:beamtick]
 
-  def render(self, screen):
-    screen.blit(self.s, (self.x, self.y))
+    # Once the beam has grown as long as it's going to, the deltas stop changing.
+    if deltas_len != len(path):
+      deltas = beam_light_deltas(path, intensity, falloff, self.opaque)
+      cache[uid] = (key, cache[uid][1], len(path), deltas)
+
+    return deltas, [pos_abs for pos_abs, pos_rel in path]
+
+  def ambient(self):
+    """ The ambient light grid, and where all the beams are. """
+    if self.baked is not None: return self.baked
+
+    window = self.window
+    ambient_light = [[255 for y in range(window.height)] for x in range(window.width)]
+    beams = []
+
+    for source in self.sources:
+      if source is None: continue
+
+      light_deltas, beam = self.source_deltas(source)
+      beams.extend(beam)
+
+      for (i, j), delta in light_deltas.iteritems():
+        if delta == 0: continue
+        if not window.collidepoint(i, j): continue
+
+        row = ambient_light[i - window.x]
+        j -= window.y
+
+        amt = row[j] + delta
+        if amt > 255: amt = 255
+        if amt < 0: amt = 0
+        row[j] = amt
+
+    return ambient_light, beams
+
+  def run(self):
+    """ Returns (window, ambient light grid, lightmap). Both of the last two
+    only cover the window. """
+    ambient_light, beams = self.ambient()
+    left, top = self.window.x * TILE_SIZE, self.window.y * TILE_SIZE
+
+    spots = self.spots
+    spots.fill((0, 0, 0, 0))
+
+    for x in range(self.window.width):
+      for y in range(self.window.height):
+        spots.fill((0, 0, 0, min(ambient_light[x][y], MIN_LIGHT)), (x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE))
+
+    surf = self.light.blur.blur(spots, 15.0)
+
+    for beam_pos in beams:
+      surf.blit(self.light.beam_img, (beam_pos[0] - left, beam_pos[1] - top))
+
+    surf = self.light.blur.blur(surf, 10.0, self.target)
+
+    return self.window, ambient_light, surf
+
+class LightWorker(object):
+  """ Runs LightingJobs on a background thread, one at a time. """
+  def __init__(self):
+    self.jobs = Queue.Queue()
+    self.results = Queue.Queue()
+    self.busy = False
+
+    self.thread = threading.Thread(target=self.work)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def work(self):
+    while True:
+      job = self.jobs.get()
+      if job is None: return
+
+      # Whatever went wrong goes back to the main thread, like a result, so
+      # it crashes there instead of waiting forever. See collect().
+      try:
+        self.results.put((job.run(), None))
+      except Exception:
+        self.results.put((None, sys.exc_info()))
+
+  def submit(self, job):
+    assert not self.busy
+    self.busy = True
+    self.jobs.put(job)
+
+  def collect(self):
+    """ Wait for the job in flight (if there is one) and return its result. """
+    if not self.busy: return None
+
+    self.busy = False
+    result, error = self.results.get()
+
+    if error is not None:
+      raise error[0], error[1], error[2]
+
+    return result
+
+  def stop(self):
+    """ Finish the job in flight, then end the thread. If the job went
+    wrong, the thread is still ended before that gets raised. """
+    try:
+      self.collect()
+    finally:
+      self.jobs.put(None)
+      self.thread.join()
+
+def bake_room_lighting(codes):
+  """ Works out the lighting an untouched room goes through as its beams
+  grow, one entry per relight until they stop growing. See bake_lights.py.
+  Returns None if there's nothing to bake. """
+  opaque = tuple(tuple(code in OPAQUE_CODES for code in column) for column in codes)
+  reflectors = frozenset()
+  sources = []
+
+  # Same order Map.build_room makes them in.
+  for i in range(len(codes)):
+    for j in range(len(codes[0])):
+      pos = (i * TILE_SIZE, j * TILE_SIZE)
+
+      if codes[i][j] == 3:
+        sources.append((LightSource.BEAM, pos[0], pos[1], (1, 0)))
+      elif codes[i][j] == 12:
+        sources.append((LightSource.BEAM, pos[0], pos[1], (-1, 0)))
+      elif codes[i][j] == 5:
+        sources.append((LightSource.RADIAL, pos[0], pos[1], None))
+      elif codes[i][j] == 4:
+        reflectors = reflectors | frozenset([pos])
+
+  if len(sources) == 0: return None
+
+  longest = max([len(trace_beam(x, y, d, opaque, reflectors)) for t, x, y, d in sources if t == LightSource.BEAM] or [0])
+  cache = {}
+  steps = []
+
+  # A brand new light has BEAM_START_LENGTH, and gets one longer before it's
+  # first drawn.
+  beamtick = BEAM_START_LENGTH + 1
+  while True:
+    states = [(uid, t, x, y, d, beamtick if t == LightSource.BEAM else 0, LightSource.INTENSITY, LightSource.FALLOFF) for uid, (t, x, y, d) in enumerate(sources)]
+    steps.append(LightingJob(None, opaque, reflectors, states, cache, pygame.Rect(0, 0, len(codes), len(codes[0]))).ambient())
+
+    if beamtick >= longest: break
+    beamtick += 1
+
+  return { "sources": sources, "opaque": opaque, "reflectors": reflectors, "steps": steps }
 
 # ALL the light in the game. ALL OF IT. Make it blurry, yo. Beacon it up in here. LOL BEACON? I DONT KNOW WHAT BEACON IS. ISNT THAT A CRISPY BREAKFAST FOOD? IVE NEVER HEARD OF IT LOL.
 class Light(Entity):
+  """ The lightmap (self.surf) and the ambient light grid are only ever
+  replaced wholesale by publish(), never drawn into, so render() and
+  get_lighting_rel() can read them while the next ones are being worked out
+  on the LightWorker. publish() flips between two lightmaps, so the one
+  being drawn is never the one being blurred into."""
   def __init__(self):
     super(Light, self).__init__(0, 0, ["renderable", "relative", "all-lights"])
+    self.cache = {}
+    self.beam_img = None
+    self.worker = None
+
+    # Only the job being run touches these, so the worker can have them.
+    self.blur = blur.Blur(LIGHT_BLUR_QUALITY)
+    self.spots = None
+    self.lightmaps = [None, None]
+    self.lightmap = 0
+
+    if THREADED_LIGHTING:
+      self.worker = LightWorker()
 
   def reinitialize(self, light_objs, entities, m):
     self.light_objs = light_objs
-    self.recalculate_light(entities, m)
+
+    # Whatever the worker is up to is for the room we just left.
+    if self.worker is not None:
+      self.worker.collect()
+
+    self.publish(self.job(entities, m).run())
 
   def depth(self):
     return LIGHT_DEPTH
 
   def get_lighting_rel(self, x, y):
-    return self.ambient_light[x][y]
+    if not self.window.collidepoint(x, y): return 255
+    return self.ambient_light[x - self.window.x][y - self.window.y]
 
-  def calculate_ambient_light(self, entities, m):
-    ambient_light = [[255 for x in range(MAP_SIZE_TILES)] for y in range(MAP_SIZE_TILES)]
+  def job(self, entities, m):
+    if self.beam_img is None:
+      self.beam_img = TileSheet.get("tiles.png", 8, 0).copy()
+      self.beam_img.set_alpha(50)
 
-    for source in entities.get("light-source"):
-      light_deltas = source.calculate_light_deltas(entities, m)
-      for i, elem in enumerate(light_deltas):
-        for j, delta in enumerate(elem):
-          ambient_light[i][j] += delta
+    return LightingJob.of(entities, m, self)
 
-          if ambient_light[i][j] > 255: ambient_light[i][j] = 255
-          if ambient_light[i][j] < 0: ambient_light[i][j] = 0
+  def scratch(self, width, height):
+    if self.spots is None or self.spots.get_size() != (width, height):
+      self.spots = pygame.Surface((width, height), pygame.SRCALPHA)
+    return self.spots
 
-    self.ambient_light = ambient_light
+  def next_lightmap(self, size):
+    self.lightmap = 1 - self.lightmap
+    if self.lightmaps[self.lightmap] is None or self.lightmaps[self.lightmap].get_size() != size:
+      self.lightmaps[self.lightmap] = pygame.Surface(size, pygame.SRCALPHA)
+    return self.lightmaps[self.lightmap]
 
   def recalculate_light(self, entities, m):
-    self.surf = pygame.Surface((MAP_SIZE_PIXELS, MAP_SIZE_PIXELS), pygame.SRCALPHA)
+    job = self.job(entities, m)
 
-    self.calculate_ambient_light(entities, m)
-
-    # calculate ambient light of each (x,y) position.
-    self.spots = [[None for x in range(MAP_SIZE_TILES)] for y in range(MAP_SIZE_TILES)]
-    for x in range(MAP_SIZE_TILES):
-      for y in range(MAP_SIZE_TILES):
-        self.spots[x][y] = LightSpot(x * TILE_SIZE, y * TILE_SIZE, self.ambient_light[x][y])
+    if self.worker is None:
+      self.publish(job.run())
+      return
 
-    # build an array of every beam object created by every light.
-    self.beams = []
+    # Show what the worker came up with last time, and start on the next one.
+    result = self.worker.collect()
+    if result is not None:
+      self.publish(result)
 
-    for source in entities.get("light-source"):
-      if "beamlight" in source.groups:
-        for beam_pos in source.light_beam_pos():
-          self.beams.append(LightBeam(beam_pos[0], beam_pos[1]))
+    self.worker.submit(job)
 
-    for x in range(MAP_SIZE_TILES):
-      for y in range(MAP_SIZE_TILES):
-        self.spots[x][y].render(self.surf)
+  def publish(self, result):
+    self.window, self.ambient_light, self.surf = result
 
-    self.surf = blur_surf(self.surf, 15.0)
+  def stop(self):
+    """ Stop the worker, once it's done with what it's working on. """
+    if self.worker is not None:
+      worker = self.worker
+      self.worker = None
+      worker.stop()
 
-    for beam in self.beams:
-      beam.render(self.surf)
+  def render(self, screen, dx, dy):
+    screen.blit(self.surf, self.screen_rect(dx, dy))
 
-    self.surf = blur_surf(self.surf, 10.0)
+  def screen_rect(self, dx=0, dy=0):
+    return pygame.Rect((dx + self.window.x * TILE_SIZE, dy + self.window.y * TILE_SIZE), self.surf.get_size())
 
-  def render(self, screen, dx, dy):
-    #screen.blit(self.surf, self.surf.get_rect().topleft)
-    screen.blit(self.surf, (dx, dy))
+  def appearance(self):
+    return self.surf
 
 
 class Tile(Entity):
+  """ Not "renderable": tiles are drawn straight out of the map's grid, so
+  the ones that can't be seen are skipped without looking at them. See
+  visible(). They aren't in the entity list either, so get() never has to
+  walk past them; Map.walls() finds the ones that are walls. They sleep
+  until somebody animates them. """
+  sleeps = True
+
   def __init__(self, x, y, tx, ty):
-    self.anim = []
-    super(Tile, self).__init__(x, y, ["renderable", "updateable", "relative"], tx, ty, "tiles.png")
+    super(Tile, self).__init__(x, y, ["tile", "updateable", "relative"], tx, ty, "tiles.png")
 
   def update(self, entities):
     super(Tile, self).update(entities)
@@ -517,12 +1125,120 @@ def isalambda(v):
   return isinstance(v, type(lambda: None)) and v.__name__ == '<lambda>'
 
 class Entities:
+  """ Every entity in the game. Entities are looked up by uid in a dict, so
+  removing one is O(1): it just leaves a tombstone behind in the ordered list,
+  which is swept out by compact() once per frame. Iteration order is always
+  insertion order, same as it was when this was a plain list.
+
+  Tiles are the exception. There are width * height of them in a room, so
+  they live in the map's grid, not in here. Only the ones that can change
+  (locks, which switches open and shut) are added, and then only to the
+  dict, so get() and friends never see them. """
   def __init__(self):
     self.entities = []
+    self.by_uid = {}
+    self.removed = set()
     self.entityInfo = []
 
+    # Things that moved (or vanished) since somebody last asked, and a counter
+    # that goes up every time the room is rebuilt. See Switchboard.
+    self.moved = {}
+    self.room_version = 0
+
+    # Everything updating() hands out, with the order they were added in.
+    self.awake = {}
+    self.order = {}
+    self.added = 0
+
+    # Persistent entities that belong to rooms other than the current one, by
+    # room. They're out of the entity list until their room comes back.
+    self.parked = {}
+
+  def report_move(self, entity):
+    self.moved[entity.uid] = entity
+
+  def take_moves(self):
+    moved = self.moved
+    self.moved = {}
+    return moved
+
   def add(self, entity):
-    self.entities.append(entity)
+    if self.by_uid.get(entity.uid) is entity: return
+    self.by_uid[entity.uid] = entity
+
+    if "updateable" in entity.groups:
+      if entity.sleeps and not entity.busy():
+        self.sleep(entity)
+      else:
+        self.awake[entity.uid] = entity
+
+    # Re-added before the tombstone was swept; it's still in the list.
+    if entity.uid in self.removed:
+      self.removed.discard(entity.uid)
+      return
+
+    if "tile" not in entity.groups:
+      self.entities.append(entity)
+    self.order[entity.uid] = self.added
+    self.added += 1
+
+  def enter_room(self, room):
+    """ Put away the persistent entities that belong to other rooms, and bring
+    back the ones that belong to room. Only the entities of those two rooms
+    are touched, however many rooms have been visited. Returns the ones that
+    were put away. """
+    leaving = [e for e in self.get("persistent") if e.restore_map_xy != room]
+
+    for e in leaving:
+      self.remove(e)
+      self.parked.setdefault(e.restore_map_xy, []).append(e)
+
+    for e in self.parked.pop(room, []):
+      self.add(e)
+
+    return leaving
+
+  def everywhere(self, *criteria):
+    """ Like get(), but also looks at what's parked in other rooms. """
+    results = self.get(*criteria)
+
+    for room in sorted(self.parked.keys()):
+      results.extend(e for e in self.parked[room] if self.elem_matches_criteria(e, *criteria))
+
+    return results
+
+  def updating(self):
+    """ Everything that needs update() calling this frame, by depth, then
+    in the order they were added. Sleepers that finished what they were
+    doing last frame drop out; ones that were woken since come back in. """
+    for e in Scheduler.take():
+      if self.alive(e) and "updateable" in e.groups:
+        self.awake[e.uid] = e
+
+    for e in self.awake.values():
+      if e.sleeps and not e.busy():
+        self.sleep(e)
+
+    order = self.order
+    return sorted(self.awake.values(), key=lambda e: (e.depth(), order[e.uid]))
+
+  def sleep(self, entity):
+    self.awake.pop(entity.uid, None)
+
+    when = entity.wakes_at()
+    if when is not None:
+      Tick.at(when, lambda: Scheduler.wake(entity))
+
+  def alive(self, entity):
+    return self.by_uid.get(entity.uid) is entity
+
+  def compact(self):
+    if len(self.removed) == 0: return
+
+    self.entities = [e for e in self.entities if e.uid not in self.removed]
+    for uid in self.removed:
+      del self.order[uid]
+    self.removed = set()
 
   def elem_matches_criteria(self, elem, *criteria):
     for criterion in criteria:
@@ -539,8 +1255,10 @@ class Entities:
 
   def get(self, *criteria):
     results = []
+    removed = self.removed
 
     for entity in self.entities:
+      if entity.uid in removed: continue
       if self.elem_matches_criteria(entity, *criteria):
         results.append(entity)
 
@@ -555,16 +1273,152 @@ class Entities:
     return len(self.get(*criteria)) > 0
 
   def remove(self, obj):
-    self.entities = [e for e in self.entities if e.uid != obj.uid]
+    if obj.uid not in self.by_uid: return
+
+    del self.by_uid[obj.uid]
+    self.awake.pop(obj.uid, None)
+    self.report_move(obj)
+
+    if "tile" in obj.groups:
+      del self.order[obj.uid]
+    else:
+      self.removed.add(obj.uid)
 
   def remove_all(self, *criteria):
+    # We're walking the whole list anyway, so sweep tombstones while we're here.
     retained = []
 
     for entity in self.entities:
-      if not self.elem_matches_criteria(entity, *criteria):
+      if entity.uid in self.removed:
+        del self.order[entity.uid]
+      elif self.elem_matches_criteria(entity, *criteria):
+        del self.by_uid[entity.uid]
+        del self.order[entity.uid]
+        self.awake.pop(entity.uid, None)
+      else:
         retained.append(entity)
 
     self.entities = retained
+    self.removed = set()
+
+    for room, parked in self.parked.items():
+      self.parked[room] = [e for e in parked if not self.elem_matches_criteria(e, *criteria)]
+
+def copy_state(state):
+  """ Copy an entity's __dict__ deep enough that mutating the entity (appending
+  to groups, flipping direction) can't touch the copy."""
+  copied = {}
+  for k, v in state.items():
+    if isinstance(v, list):
+      v = list(v)
+    elif isinstance(v, dict):
+      v = dict(v)
+    copied[k] = v
+  return copied
+
+def is_plain(v):
+  if v is None or isinstance(v, (bool, int, long, float, basestring)):
+    return True
+  if isinstance(v, (tuple, list)):
+    return all(is_plain(x) for x in v)
+  return False
+
+class Snapshot(object):
+  """ The state of a bunch of entities at some point in time. Restoring puts
+  the very same objects back into the game with their old state, so nothing
+  has to be constructed or loaded from disk again."""
+  def __init__(self, ents):
+    self.states = [(e, copy_state(e.__dict__)) for e in ents]
+
+  def restore(self, entities, keep=None):
+    for e, state in self.states:
+      if keep is not None and not keep(e): continue
+
+      e.__dict__.clear()
+      e.__dict__.update(copy_state(state))
+      entities.add(e)
+
+class WorldSnapshot(object):
+  """ Everything that survives leaving a room, for saving: the character, the
+  persistent crates/lights/powerups, which dialogs were read and which rooms
+  were seen. Rooms themselves are rebuilt from the map's room snapshots."""
+  def __init__(self, entities):
+    m = entities.one("map")
+
+    self.room = m.get_mapxy()
+    self.seen_maps = list(m.seen_maps)
+    self.dialog_seen = dict(Dialog.SEEN)
+    self.actors = Snapshot(entities.everywhere("persistent") + entities.get("character"))
+
+  def save(self, path):
+    actors = []
+    for e, state in self.actors.states:
+      plain = dict((k, v) for k, v in state.items() if k != "uid" and is_plain(v))
+      actors.append((e.__class__.__name__, plain))
+
+    data = { "room": self.room
+           , "seen_maps": self.seen_maps
+           , "dialog_seen": self.dialog_seen.keys()
+           , "actors": actors
+           }
+
+    f = open(path, "wb")
+    pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    f.close()
+
+  @staticmethod
+  def read(path):
+    """ What save() wrote to path, or None if there's nothing (readable)
+    there. """
+    if not os.path.exists(path): return None
+
+    try:
+      f = open(path, "rb")
+      try:
+        return pickle.load(f)
+      finally:
+        f.close()
+    except (IOError, EOFError, pickle.UnpicklingError):
+      return None
+
+  @staticmethod
+  def load(path, entities):
+    """ Go back to what was saved to path. Returns False, having done
+    nothing, if nothing was. """
+    data = WorldSnapshot.read(path)
+    if data is None: return False
+
+    m = entities.one("map")
+    entities.remove_all("persistent")
+
+    for name, state in data["actors"]:
+      x, y = state["x"], state["y"]
+
+      if name == "Character":
+        e = entities.one("character")
+      elif name == "PushBlock":
+        e = PushBlock(x, y, m)
+      elif name == "LightSource":
+        e = LightSource(x, y, entities, m, state["light_type"])
+      elif name == "Powerup":
+        e = Powerup(x, y, Powerup.SANITY, m)
+      else:
+        assert(False)
+
+      e.__dict__.update(state)
+      entities.add(e)
+
+    ch = entities.one("character")
+    ch.hp_bar.set_amt(ch.hp)
+    ch.hp_bar.set_max_amt(ch.max_hp)
+    ch.sanity_bar.set_amt(ch.sanity)
+    ch.sanity_bar.set_max_amt(ch.max_sanity)
+
+    Dialog.SEEN = dict((loc, True) for loc in data["dialog_seen"])
+    m.seen_maps = list(data["seen_maps"])
+    m.new_map_abs(entities, *data["room"])
+
+    return True
 
 def tupleize(color):
   return (color.r, color.g, color.b)
@@ -579,8 +1433,115 @@ def w_choice(lst):
     n = n - weight
   return item
 
+# The color of each pixel in laderp.bmp says what goes in that tile.
+MAP_COLORS = { (0, 0, 0): 1 # Background
+             , (255, 255, 255): 0 # Wall
+             , (255, 0, 0): 2 #dumbEnemy
+             , (0, 0, 100): 3 # beam light source, right.
+             , (100, 100, 100): 4 #reflector
+             , (0, 0, 255): 5 # radial light source
+             , (200, 0, 0): 6 # sentry
+             , (50, 0, 0): 7 # science-wall
+             , (100, 0, 0): 8 # sweeper
+             , (222, 222, 222): 9 # push-crate
+             , (0, 255, 0): 10 # switch
+             , (0, 100, 0): 11 # lock-box
+             , (0, 0, 200): 12 # beam light source, left
+             , (255, 255, 0): 13 # glass
+             , (255, 128, 0): 14 # +1 sanity
+             , (111, 111, 111): 15 # Dialog
+             , (50, 100, 150): 16 # Winner
+             }
+
+# Tiles that block light. (Glass is a wall, but you can see through it.)
+OPAQUE_CODES = (1, 7, 11)
+
+MAP_FILE = "laderp.bmp"
+LEVEL_FILE = "laderp.lvl"
+BAKED_LIGHT_FILE = "lights.bake"
+# lights.bake starts with this and the md5 of the MAP_FILE it was baked from,
+# then the pickled bakes. Bump the magic whenever the lighting code changes.
+BAKE_MAGIC = "LD23BAK1"
+BAKE_HEADER = struct.Struct("<8s16s")
+
+def map_digest():
+  """ The md5 of MAP_FILE, which a compiled level has to have been compiled
+  from to be any use. Modification times don't survive packaging. """
+  f = open(MAP_FILE, "rb")
+  digest = hashlib.md5(f.read()).digest()
+  f.close()
+  return digest
+
+def room_codes(mapdata):
+  """ The MAP_COLORS code of every tile in a room's chunk of laderp.bmp. """
+  return [[MAP_COLORS[tupleize(mapdata.get_at((i, j)))] for j in range(MAP_SIZE_TILES)] for i in range(MAP_SIZE_TILES)]
+
+# What a compiled room's tiles can be, as (backgrounds, groups). backgrounds
+# is either a list to w_choice() from, or the one tile to always use.
+TILE_FLOOR, TILE_DIRT, TILE_DIRT_TOP, TILE_EMPTY, TILE_SCIENCE, TILE_LOCK, TILE_GLASS = range(7)
+TILE_KINDS = { TILE_FLOOR: ([((0, 0), 0.9), ((10, 0), 0.03), ((11, 0), 0.03), ((12, 0), 0.04)], ())
+             , TILE_DIRT: ([((5, 1), 1.0)], ("wall",)) # dirt with more dirt above it
+             , TILE_DIRT_TOP: ([((2, 0), 0.8), ((1, 0), 0.1), ((4, 1), 0.1)], ("wall",))
+             , TILE_EMPTY: ((0, 0), ())
+             , TILE_SCIENCE: ((16, 0), ("wall",))
+             , TILE_LOCK: ((7, 2), ("lock", "wall"))
+             , TILE_GLASS: ((0, 0), ("wall", "glass"))
+             }
+
+# What a compiled room can have in it besides tiles.
+(SPAWN_STUPID, SPAWN_SENTRY, SPAWN_SWEEPER, SPAWN_BEAM, SPAWN_BEAM_LEFT, SPAWN_RADIAL, SPAWN_REFLECTOR,
+ SPAWN_PUSH_BLOCK, SPAWN_SWITCH, SPAWN_GLASS, SPAWN_SANITY, SPAWN_DIALOG, SPAWN_WIN) = range(13)
+
+# MAP_COLORS code -> (tile kind, spawn kind or None). Dirt is worked out
+# separately, since it depends on what's above it.
+CODE_KINDS = { 0: (TILE_FLOOR, None)
+             , 2: (TILE_EMPTY, SPAWN_STUPID)
+             , 3: (TILE_EMPTY, SPAWN_BEAM)
+             , 4: (TILE_EMPTY, SPAWN_REFLECTOR)
+             , 5: (TILE_EMPTY, SPAWN_RADIAL)
+             , 6: (TILE_EMPTY, SPAWN_SENTRY)
+             , 7: (TILE_SCIENCE, None)
+             , 8: (TILE_EMPTY, SPAWN_SWEEPER)
+             , 9: (TILE_EMPTY, SPAWN_PUSH_BLOCK)
+             , 10: (TILE_EMPTY, SPAWN_SWITCH)
+             , 11: (TILE_LOCK, None)
+             , 12: (TILE_EMPTY, SPAWN_BEAM_LEFT)
+             , 13: (TILE_GLASS, SPAWN_GLASS)
+             , 14: (TILE_EMPTY, SPAWN_SANITY)
+             , 15: (TILE_EMPTY, SPAWN_DIALOG)
+             , 16: (TILE_EMPTY, SPAWN_WIN)
+             }
+
+def compile_room(codes):
+  """ Turn room_codes() into (width, height, tiles, spawns): a tile kind for
+  every tile, column by column, and a (spawn kind, x, y) for everything
+  else. """
+  width, height = len(codes), len(codes[0])
+  tiles = []
+  spawns = []
+
+  for i in range(width):
+    for j in range(height):
+      code = codes[i][j]
+
+      if code == 1:
+        tiles.append(TILE_DIRT if j > 0 and codes[i][j - 1] == 1 else TILE_DIRT_TOP)
+        continue
+
+      tile, spawn = CODE_KINDS[code]
+      tiles.append(tile)
+      if spawn is not None: spawns.append((spawn, i, j))
+
+  return width, height, tiles, spawns
 
 class Map(Entity):
+  # room -> lighting from bake_lights.py, loaded the first time it's needed.
+  baked = None
+
+  # The compiled level from compile_level.py, loaded the first time it's
+  # needed. False if there isn't one, or laderp.bmp has changed since.
+  level = None
+
   def __init__(self):
     self.full_map_size = MAP_SIZE_TILES
     self.mapx = 0
@@ -588,6 +1549,20 @@ class Map(Entity):
     self.visible_map_size = VISIBLE_MAP_SIZE
     self.light_deltas = None
     self.seen_maps = []
+    self.rooms = {}
+    self.reflectors = {}
+
+    # The current room's tiles, column by column, and how many of them there
+    # are each way.
+    self.tiles = []
+    self.locks = []
+    self.width = MAP_SIZE_TILES
+    self.height = MAP_SIZE_TILES
+
+    # Goes up whenever a tile turns opaque or see-through (or the whole room
+    # changes), so anything traced through the room knows to trace again.
+    self.layout_version = 0
+    self.opacity_grids = {}
 
     super(Map, self).__init__(0, 0, ["updateable", "map"])
 
@@ -600,8 +1575,39 @@ class Map(Entity):
   def new_map_rel(self, entities, dx, dy):
     self.new_map_abs(entities, self.mapx + dx, self.mapy + dy)
 
+  def pixel_size(self):
+    return (self.width * TILE_SIZE, self.height * TILE_SIZE)
+
   def in_bounds(self, point):
-    return point[0] >= 0 and point[1] >= 0 and point[0] < MAP_SIZE_PIXELS and point[1] < MAP_SIZE_PIXELS
+    width, height = self.pixel_size()
+    return point[0] >= 0 and point[1] >= 0 and point[0] < width and point[1] < height
+
+  def lit_window(self, x, y):
+    """ The chunks within LIGHT_REACH of pixel (x, y), as a Rect in tiles. """
+    width, height = self.pixel_size()
+    x = max(0, min(x, width))
+    y = max(0, min(y, height))
+
+    left = int(max(0, x - LIGHT_REACH) // CHUNK_PIXELS) * CHUNK_TILES
+    top = int(max(0, y - LIGHT_REACH) // CHUNK_PIXELS) * CHUNK_TILES
+    right = min(self.width, (int((x + LIGHT_REACH) // CHUNK_PIXELS) + 1) * CHUNK_TILES)
+    bottom = min(self.height, (int((y + LIGHT_REACH) // CHUNK_PIXELS) + 1) * CHUNK_TILES)
+
+    return pygame.Rect(left, top, right - left, bottom - top)
+
+  def walls(self, entities, left, top, right, bottom, *criteria):
+    """ The walls that match criteria, out of the ones that could touch the
+    box from (left, top) to (right, bottom). Tiles come out of the grid, so
+    only the handful around the box get looked at. """
+    found = []
+
+    for i in range(max(0, int(left // TILE_SIZE) - 1), min(self.width, int(right // TILE_SIZE) + 1)):
+      for j in range(max(0, int(top // TILE_SIZE) - 1), min(self.height, int(bottom // TILE_SIZE) + 1)):
+        tile = self.tiles[i][j]
+        if "wall" in tile.groups and entities.elem_matches_criteria(tile, *criteria):
+          found.append(tile)
+
+    return found + entities.get("wall", *criteria)
 
   def new_map_abs(self, entities, x, y):
     self.mapx = x
@@ -610,129 +1616,231 @@ class Map(Entity):
     self.seen_maps.append((self.mapx, self.mapy))
 
     entities.remove_all("map_element")
+    for tile in self.locks:
+      entities.remove(tile)
+
+    entities.room_version += 1
+    self.touch_layout()
+
+    for e in entities.enter_room(self.get_mapxy()):
+      if "wall" in e.groups:
+        e.groups.remove("wall")
+
+    if self.get_mapxy() in self.rooms:
+      particle_sources = self.restore_room(entities)
+      light_sources = []
+    else:
+      particle_sources, light_sources = self.build_room(entities, new_map)
+
+    # Only this room's are left by now.
+    for e in entities.get("persistent"):
+      e.x = e.restore_xy[0]
+      e.y = e.restore_xy[1]
+      if "wall" not in e.groups: e.add_group("wall")
+
+    self.calculate_lighting(light_sources, entities)
 
-    self.mapdata = TileSheet.get('laderp.bmp', self.mapx, self.mapy)
-
-    mapping = { (0, 0, 0): 1 # Background
-              , (255, 255, 255): 0 # Wall
-              , (255, 0, 0): 2 #dumbEnemy
-              , (0, 0, 100): 3 # beam light source, right.
-              , (100, 100, 100): 4 #reflector
-              , (0, 0, 255): 5 # radial light source
-              , (200, 0, 0): 6 # sentry
-              , (50, 0, 0): 7 # science-wall
-              , (100, 0, 0): 8 # sweeper
-              , (222, 222, 222): 9 # push-crate
-              , (0, 255, 0): 10 # switch
-              , (0, 100, 0): 11 # lock-box
-              , (0, 0, 200): 12 # beam light source, left
-              , (255, 255, 0): 13 # glass
-              , (255, 128, 0): 14 # +1 sanity
-              , (111, 111, 111): 15 # Dialog
-              , (50, 100, 150): 16 # Winner
-              }
-
-    self.tiles = [[None for i in range(MAP_SIZE_TILES)] for j in range(MAP_SIZE_TILES)]
+  def restore_room(self, entities):
+    """ Put a room we've already built back the way it was when we first built
+    it. Only what can have changed gets restored, so it costs the same however
+    big the room is. """
+    snapshot, tiles, locks, reflectors, particle_sources = self.rooms[self.get_mapxy()]
+
+    snapshot.restore(entities, lambda e: not ("dialog" in e.groups and e.loc in Dialog.SEEN))
+    self.tiles = tiles
+    self.width = len(tiles)
+    self.height = len(tiles[0])
+    self.locks = locks
+    self.reflectors = reflectors
+
+    return particle_sources
+
+  def build_room(self, entities, new_map):
+    self.width, self.height, tiles, spawns = self.room_data()
+    spawn_at = dict(((i, j), kind) for kind, i, j in spawns)
+
+    self.tiles = [[None for j in range(self.height)] for i in range(self.width)]
+    self.locks = []
+    self.reflectors = {}
 
     particle_sources = []
     light_sources = []
 
-    all_colors = [[mapping[tupleize(self.mapdata.get_at((i, j)))] for j in range(MAP_SIZE_TILES)] for i in range(MAP_SIZE_TILES)]
+    for i in range(self.width):
+      for j in range(self.height):
+        backgrounds, groups = TILE_KINDS[tiles[i * self.height + j]]
+        if isinstance(backgrounds, list):
+          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, *w_choice(backgrounds))
+        else:
+          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, *backgrounds)
 
-    for i in range(MAP_SIZE_TILES):
-      for j in range(MAP_SIZE_TILES):
-        colors = all_colors[i][j]
+        for group in groups:
+          tile.add_group(group)
 
-        if colors == 0:
-          backgrounds = [((0, 0), 0.9), ((10, 0), 0.03), ((11, 0), 0.03), ((12, 0), 0.04)]
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, *w_choice(backgrounds))
-        elif colors == 1: # dirt 'wall'
-          backgrounds = []
-          if j > 0 and all_colors[i][j - 1] == 1: # if dirt above current position
-            backgrounds = [((5, 1), 1.0)]
-          else:
-            backgrounds = [((2, 0), 0.8), ((1, 0), 0.1), ((4, 1), 0.1)]
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, *w_choice(backgrounds))
-          tile.add_group("wall")
-        elif colors == 2:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          entities.add(Enemy(i * TILE_SIZE, j * TILE_SIZE, Enemy.STRATEGY_STUPID))
-        elif colors == 3:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          particle_sources.append([i * TILE_SIZE, j * TILE_SIZE])
-          if new_map: light_sources.append([i * TILE_SIZE, j * TILE_SIZE, LightSource.BEAM])
-        elif colors == 4:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          entities.add(Reflector(i * TILE_SIZE, j * TILE_SIZE, None))
-        elif colors == 5:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          #particle_sources.append([i * TILE_SIZE, j * TILE_SIZE])
-          if new_map: light_sources.append([i * TILE_SIZE, j * TILE_SIZE, LightSource.RADIAL])
-        elif colors == 6:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          entities.add(Enemy(i * TILE_SIZE, j * TILE_SIZE, Enemy.STRATEGY_SENTRY))
-        elif colors == 7:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 16, 0)
-          tile.add_group("wall")
-        elif colors == 8:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          entities.add(Enemy(i * TILE_SIZE, j * TILE_SIZE, Enemy.STRATEGY_SWEEPER))
-        elif colors == 9:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          if new_map: entities.add(PushBlock(i * TILE_SIZE, j * TILE_SIZE, self))
-        elif colors == 10:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          entities.add(Switch(i * TILE_SIZE, j * TILE_SIZE, self))
-        elif colors == 11:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 7, 2)
-          tile.add_group("lock")
-          tile.add_group("wall")
-        elif colors == 12:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          particle_sources.append([i * TILE_SIZE, j * TILE_SIZE])
-          if new_map: light_sources.append([i * TILE_SIZE, j * TILE_SIZE, LightSource.BEAM_LEFT])
-        elif colors == 13:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          tile.add_group("wall")
-          tile.add_group("glass")
-          entities.add(Glass(i * TILE_SIZE, j * TILE_SIZE))
-        elif colors == 14:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          if new_map: entities.add(Powerup(i * TILE_SIZE, j * TILE_SIZE, Powerup.SANITY, self))
-        elif colors == 15:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          if self.get_mapxy() not in Dialog.SEEN:
-            entities.add(Dialog(i * TILE_SIZE, j * TILE_SIZE, self.get_mapxy()))
-        elif colors == 16:
-          tile = Tile(i * TILE_SIZE, j * TILE_SIZE, 0, 0)
-          entities.add(YouWin(i * TILE_SIZE, j * TILE_SIZE))
+        if (i, j) in spawn_at:
+          self.spawn(entities, spawn_at[(i, j)], i * TILE_SIZE, j * TILE_SIZE, new_map, particle_sources, light_sources)
 
         tile.add_group("map_element")
-        entities.add(tile)
         self.tiles[i][j] = tile
-
-    for e in entities.get("persistent"):
-      if self.get_mapxy() == e.restore_map_xy:
-        e.x = e.restore_xy[0]
-        e.y = e.restore_xy[1]
-        if "wall" not in e.groups: e.add_group("wall")
-      else:
-        if "wall" in e.groups:
-          e.groups.remove("wall")
-
-    self.calculate_lighting(light_sources, entities)
+        if "lock" in tile.groups:
+          entities.add(tile)
+          self.locks.append(tile)
+
+    # Everything in the room is brand new right now, so remember it like this.
+    # The rest of the tiles never change, so there's no need to.
+    changing = self.locks + entities.get("map_element")
+    self.rooms[self.get_mapxy()] = (Snapshot(changing), self.tiles, self.locks, self.reflectors, particle_sources)
+
+    return particle_sources, light_sources
+
+  def room_data(self):
+    """ The compiled (width, height, tiles, spawns) for this room. They come out of the
+    compiled level if there's an up to date one, otherwise laderp.bmp gets
+    compiled on the spot. """
+    Map.load_level()
+    if Map.level and self.get_mapxy() in Map.level:
+      return Map.level.room(self.get_mapxy())
+
+    return compile_room(room_codes(TileSheet.get(MAP_FILE, self.mapx, self.mapy)))
+
+  def spawn(self, entities, kind, x, y, new_map, particle_sources, light_sources):
+    if kind == SPAWN_STUPID:
+      entities.add(Enemy(x, y, Enemy.STRATEGY_STUPID))
+    elif kind == SPAWN_SENTRY:
+      entities.add(Enemy(x, y, Enemy.STRATEGY_SENTRY))
+    elif kind == SPAWN_SWEEPER:
+      entities.add(Enemy(x, y, Enemy.STRATEGY_SWEEPER))
+    elif kind == SPAWN_BEAM:
+      particle_sources.append([x, y])
+      if new_map: light_sources.append([x, y, LightSource.BEAM])
+    elif kind == SPAWN_BEAM_LEFT:
+      particle_sources.append([x, y])
+      if new_map: light_sources.append([x, y, LightSource.BEAM_LEFT])
+    elif kind == SPAWN_RADIAL:
+      if new_map: light_sources.append([x, y, LightSource.RADIAL])
+    elif kind == SPAWN_REFLECTOR:
+      reflector = Reflector(x, y, None)
+      self.reflectors[(reflector.x, reflector.y)] = reflector
+      entities.add(reflector)
+    elif kind == SPAWN_PUSH_BLOCK:
+      if new_map: entities.add(PushBlock(x, y, self))
+    elif kind == SPAWN_SWITCH:
+      entities.add(Switch(x, y, self))
+    elif kind == SPAWN_GLASS:
+      entities.add(Glass(x, y))
+    elif kind == SPAWN_SANITY:
+      if new_map: entities.add(Powerup(x, y, Powerup.SANITY, self))
+    elif kind == SPAWN_DIALOG:
+      if self.get_mapxy() not in Dialog.SEEN:
+        entities.add(Dialog(x, y, self.get_mapxy()))
+    elif kind == SPAWN_WIN:
+      entities.add(YouWin(x, y))
+
+  def touch_layout(self):
+    self.layout_version += 1
+
+  def opacity(self):
+    """ is_opaq_rel for every tile in the room, as nested tuples. Locks are
+    the only tiles that change, so it's worked out once per room and way
+    its locks are, and coming back to a room costs nothing. """
+    key = (self.get_mapxy(), tuple("wall" in lock.groups for lock in self.locks))
+    if key not in self.opacity_grids:
+      self.opacity_grids[key] = tuple(tuple(self.is_opaq_rel(i, j) for j in range(self.height)) for i in range(self.width))
+
+    return self.opacity_grids[key]
 
   def is_wall_rel(self, i, j):
-    if i < 0 or j < 0 or i >= MAP_SIZE_TILES or j >= MAP_SIZE_TILES: return False
+    if i < 0 or j < 0 or i >= self.width or j >= self.height: return False
     return "wall" in self.tiles[i][j].groups
 
   def is_opaq_rel(self, i, j):
-    if i < 0 or j < 0 or i >= MAP_SIZE_TILES or j >= MAP_SIZE_TILES: return False
+    if i < 0 or j < 0 or i >= self.width or j >= self.height: return False
 
     if "glass" in self.tiles[i][j].groups: return False
     return "wall" in self.tiles[i][j].groups
 
+  @staticmethod
+  def preload():
+    """ Read in everything building rooms needs from the disk. """
+    Map.load_level()
+    if Map.level:
+      Map.level.preload()
+    else:
+      TileSheet.add(MAP_FILE)
+
+    Map.load_baked_lighting()
+
+  @staticmethod
+  def load_level():
+    if Map.level is not None: return
+
+    Map.level = False
+    if not os.path.exists(LEVEL_FILE): return
+
+    try:
+      compiled = level.Level(LEVEL_FILE)
+    except ValueError:
+      # Compiled by an older compile_level.py.
+      return
+
+    # Without laderp.bmp, there's nothing it could be out of date with.
+    if os.path.exists(MAP_FILE) and compiled.source != map_digest():
+      compiled.close()
+      return
+
+    Map.level = compiled
+
+  @staticmethod
+  def load_baked_lighting():
+    if Map.baked is not None: return
+
+    Map.baked = {}
+    if not os.path.exists(BAKED_LIGHT_FILE): return
+
+    # Anything wrong with the bake just means lighting everything live.
+    f = open(BAKED_LIGHT_FILE, "rb")
+    try:
+      magic, source = BAKE_HEADER.unpack(f.read(BAKE_HEADER.size))
+      if magic != BAKE_MAGIC: return
+      if os.path.exists(MAP_FILE) and source != map_digest(): return
+      baked = pickle.load(f)
+    except Exception:
+      return
+    finally:
+      f.close()
+
+    Map.baked = baked
+
+  @staticmethod
+  def baked_lighting(room, job):
+    """ The baked (ambient, beams) for the room, if nothing that affects the
+    lighting has changed since it was baked. Otherwise None. """
+    bake = Map.baked.get(room)
+    if bake is None: return None
+    if job.opaque != bake["opaque"]: return None
+    if job.reflectors != bake["reflectors"]: return None
+
+    sources = [s for s in job.sources if s is not None]
+    if len(sources) != len(bake["sources"]): return None
+
+    beamticks = set()
+    for (uid, t, x, y, d, beamtick, intensity, falloff), baked_source in zip(sources, bake["sources"]):
+      if (t, x, y, d) != baked_source: return None
+      if (intensity, falloff) != (LightSource.INTENSITY, LightSource.FALLOFF): return None
+      if t == LightSource.BEAM: beamticks.add(beamtick)
+
+    if len(beamticks) > 1: return None
+
+    step = 0
+    if len(beamticks) == 1:
+      step = beamticks.pop() - (BEAM_START_LENGTH + 1)
+      if step < 0: return None
+
+    return bake["steps"][min(step, len(bake["steps"]) - 1)]
+
   def calculate_lighting(self, light_sources, entities):
+    Map.load_baked_lighting()
+
     # everything starts dark.
     light_objs = []
 
@@ -747,40 +1855,129 @@ class Map(Entity):
     entities.one("all-lights").reinitialize(light_objs, entities, self)
 
 class UpKeys:
-  """ Simple abstraction to check for recent key released behavior. """
-  keysup = []
-  keysactive = []
+  """ Which keys are held down, and which were pressed this frame. Both are
+  bitsets (plain ints) with a bit per key, so every lookup is constant time
+  and a key can't be held down twice.
+
+  The main loop calls flush() once at the start of every frame, then feeds
+  in that frame's key events. A press can be picked up by key_up() once, any
+  time during the frame it happened in. """
+  down = 0
+  pressed = 0
+
+  @staticmethod
+  def bit(key):
+    # SDL 2 keys that aren't characters are scancodes with bit 30 set. Fold
+    # them in after the first 512 so the bitsets stay small.
+    if key >= 512: key = 512 + (key & 511)
+    return 1 << key
 
   @staticmethod
   def flush():
-    UpKeys.keysup = []
+    UpKeys.pressed = 0
 
   @staticmethod
   def add_key(val):
-    UpKeys.keysup.append(val)
-    UpKeys.keysactive.append(val)
+    bit = UpKeys.bit(val)
+    UpKeys.pressed |= bit
+    UpKeys.down |= bit
 
   @staticmethod
   def invalidate_key(val):
-    if val in UpKeys.keysup: UpKeys.keysup.remove(val)
+    UpKeys.pressed &= ~UpKeys.bit(val)
 
   # This is a setter.
   @staticmethod
   def release_key(val):
-    if val in UpKeys.keysactive:
-      UpKeys.keysactive.remove(val)
+    UpKeys.down &= ~UpKeys.bit(val)
 
   @staticmethod
   def key_down(val):
-    return val in UpKeys.keysactive
+    return UpKeys.down & UpKeys.bit(val) != 0
 
   @staticmethod
   def key_up(val):
-    if val in UpKeys.keysup:
-      UpKeys.keysup.remove(val)
+    bit = UpKeys.bit(val)
+    if UpKeys.pressed & bit:
+      UpKeys.pressed &= ~bit
       return True
     return False
 
+class Replay:
+  """ A recording of every key event the main loop saw, tick by tick, along
+  with the seed the RNG was started with. Everything else in the game is
+  deterministic, so feeding the same events back in replays the session.
+
+  The file is a header (magic "LD23RPL2", seed) followed by one record per
+  tick that had any key events: (tick, count) and then (kind, key) for each
+  of up to 255 events. The last record is always an empty one, for the tick
+  the recording ended on."""
+  MAGIC = "LD23RPL2"
+  HEADER = struct.Struct("<8sI")
+  TICK = struct.Struct("<IB")
+  EVENT = struct.Struct("<BI")
+
+  KEYDOWN = 1
+  KEYUP = 2
+
+  def __init__(self, seed, events=None):
+    self.seed = seed
+    self.events = events or {}
+    self.last_tick = max(self.events.keys() or [0])
+    self.out = None
+    self.tick = 0
+
+  @staticmethod
+  def record(path):
+    replay = Replay(random.randrange(2 ** 32))
+    replay.out = open(path, "wb")
+    replay.out.write(Replay.HEADER.pack(Replay.MAGIC, replay.seed))
+    return replay
+
+  @staticmethod
+  def load(path):
+    f = open(path, "rb")
+    data = f.read()
+    f.close()
+
+    magic, seed = Replay.HEADER.unpack_from(data, 0)
+    if magic != Replay.MAGIC: raise ValueError("%s is not a replay file." % path)
+
+    events = {}
+    pos = Replay.HEADER.size
+    while pos < len(data):
+      tick, count = Replay.TICK.unpack_from(data, pos)
+      pos += Replay.TICK.size
+
+      events[tick] = []
+      for i in range(count):
+        events[tick].append(Replay.EVENT.unpack_from(data, pos))
+        pos += Replay.EVENT.size
+
+    return Replay(seed, events)
+
+  def add(self, tick, events):
+    self.tick = tick
+    if len(events) == 0: return
+
+    # One byte of count per tick. Nobody hits 255 keys in 1/60th of a second.
+    events = events[:255]
+    self.out.write(Replay.TICK.pack(tick, len(events)))
+    for kind, key in events:
+      self.out.write(Replay.EVENT.pack(kind, key))
+
+  def get(self, tick):
+    return self.events.get(tick, [])
+
+  def finished(self, tick):
+    return tick > self.last_tick
+
+  def close(self):
+    if self.out is not None:
+      self.out.write(Replay.TICK.pack(self.tick, 0))
+      self.out.close()
+      self.out = None
+
 def sign(a):
   if a > 0: return 1
   if a < 0: return -1
@@ -807,14 +2004,14 @@ class Text(Entity):
       else:
         self.shown_chars = self.tot_chars
 
-    if Tick.get(3) and self.shown_chars < self.tot_chars:
+    if Tick.due(3, self.uid) and self.shown_chars < self.tot_chars:
       self.shown_chars += 1
 
   def render(self, screen, dx, dy):
     if not self.visible: return
 
     my_width = 300
-    my_font = pygame.font.Font("nokiafc22.ttf", 12)
+    my_font = Fonts.get(TEXT_SIZE)
     vis_text = self.contents[:self.shown_chars] + "\n(press z)"
 
     my_rect = pygame.Rect((self.follow.x + dx - my_width / 2, self.follow.y + dy - len(vis_text) - 30, my_width, 150))
@@ -826,9 +2023,100 @@ class Text(Entity):
 
     screen.blit(rendered_text, my_rect.topleft)
 
+  def screen_rect(self, dx=0, dy=0):
+    # Always the same place, see render().
+    return pygame.Rect(0, 50, 300, 150)
+
+  def appearance(self):
+    return (self.contents, self.shown_chars, self.colored, bool(self.visible))
+
+class HudImage(object):
+  """ A HUD widget drawn once for as long as it looks the same, and a copy
+  of that faded to whatever alpha it was last asked for. A widget and its
+  snapshots share one of these, which is fine: what's in it always matches
+  what it says it's of. """
+  def __init__(self):
+    self.looks = None
+    self.image = None
+    self.faded = None
+    self.alpha = None
+
+  def get(self, looks, draw, alpha):
+    """ The widget looking like looks, at alpha. draw() is only called if it
+    looked different last time. """
+    if looks != self.looks:
+      self.looks = looks
+      self.image = draw()
+      self.faded = self.image.copy()
+      self.alpha = None
+
+    alpha = max(0, min(255, alpha))
+    if alpha == 255:
+      return self.image
+
+    if alpha != self.alpha:
+      self.alpha = alpha
+      self.faded.fill((0, 0, 0, 0))
+      self.faded.blit(self.image, (0, 0), None, pygame.BLEND_RGBA_ADD)
+      self.faded.fill((255, 255, 255, alpha), None, pygame.BLEND_RGBA_MULT)
+
+    return self.faded
+
+class Hud(Entity):
+  """ Draws widgets (anything with x, y, visible and image()) onto one
+  surface, which gets blitted once a frame. It's only redrawn when one of
+  them moves, changes, fades, or shows up or goes away. The widgets are
+  updated by themselves, before this is. """
+  def __init__(self, widgets):
+    super(Hud, self).__init__(0, 0, ["renderable", "updateable", "hud", "relative"])
+    self.widgets = widgets
+    self.layout = ()
+    self.bounds = pygame.Rect(0, 0, 0, 0)
+    self.surf = pygame.Surface((0, 0), pygame.SRCALPHA)
+
+  def depth(self):
+    return BAR_DEPTH
+
+  def update(self, entities):
+    layout = tuple((w.image(), w.alpha, w.x, w.y) for w in self.widgets if w.visible)
+    if layout == self.layout: return
+
+    self.layout = layout
+    rects = [img.get_rect(topleft=(x, y)) for img, alpha, x, y in layout]
+    if len(rects) == 0:
+      self.bounds = pygame.Rect(0, 0, 0, 0)
+      return
+
+    self.bounds = rects[0].unionall(rects[1:])
+
+    # Only ever grows, so jiggling widgets don't mean a new surface.
+    width, height = self.surf.get_size()
+    if self.bounds.width > width or self.bounds.height > height:
+      self.surf = pygame.Surface((max(width, self.bounds.width), max(height, self.bounds.height)), pygame.SRCALPHA)
+
+    self.surf.fill((0, 0, 0, 0), ((0, 0), self.bounds.size))
+
+    # Widgets never overlap, so they're copied in, alpha and all, rather
+    # than blended with each other.
+    for (img, alpha, x, y), rect in zip(layout, rects):
+      self.surf.blit(img, rect.move(-self.bounds.x, -self.bounds.y), None, pygame.BLEND_RGBA_ADD)
+
+  def render(self, screen, dx, dy):
+    if len(self.layout) == 0: return
+
+    screen.blit(self.surf, self.bounds.move(dx, dy), ((0, 0), self.bounds.size))
+
+  def screen_rect(self, dx=0, dy=0):
+    return self.bounds.move(dx, dy)
+
+  def appearance(self):
+    return self.layout
+
 class Bar(Entity):
+  """ A bar that hangs over follow, like the character's health. It's a
+  widget on the character's Hud, which draws it. """
   def __init__(self, follow, color_health, color_no_health, amt, max_amt, y_ofs=0):
-    super(Bar, self).__init__(follow.x, follow.y, ["renderable", "updateable", "healthbar", "relative"])
+    super(Bar, self).__init__(follow.x, follow.y, ["updateable", "healthbar", "relative"])
     self.amt = amt
     self.max_amt = max_amt
     self.color_health = color_health
@@ -840,7 +2128,8 @@ class Bar(Entity):
     self.border_width = 2
     self.y_ofs = y_ofs
 
-    self.img = pygame.Surface((self.width, self.height), pygame.SRCALPHA)
+    self.cache = HudImage()
+
   def set_amt(self, x):
     self.amt = x
 
@@ -851,31 +2140,34 @@ class Bar(Entity):
     return BAR_DEPTH
 
   def update(self, entities):
+    # Faded out last update, and was drawn one last time.
+    if self.alpha <= 0:
+      self.visible = False
+
     self.x = self.follow.x - self.follow.size / 2
     self.y = self.follow.y - 10 - self.y_ofs
 
+    super(Bar, self).update(entities)
+
+  def draw(self):
+    img = pygame.Surface((self.width, self.height), pygame.SRCALPHA)
+
     # Outer border
-    pygame.draw.rect(self.img, (0, 0, 0), (0, 0, self.width, self.height))
+    img.fill((0, 0, 0))
 
     # Inside
     actual_w = self.width - self.border_width * 2
     actual_h = self.height - self.border_width * 2
-    pygame.draw.rect(self.img, self.color_no_health, (self.border_width, self.border_width, actual_w, actual_h))
+    img.fill(self.color_no_health, (self.border_width, self.border_width, actual_w, actual_h))
 
     # 'Health'
-    health_w = (self.amt / self.max_amt) * actual_w
-    pygame.draw.rect(self.img, self.color_health, (self.border_width, self.border_width, health_w, actual_h))
-
-    super(Bar, self).update(entities)
-
-  def render(self, screen, dx, dy):
-    if not self.visible: return
-    if self.alpha <= 0:
-      self.visible = False
+    health_w = self.amt * actual_w // self.max_amt
+    img.fill(self.color_health, (self.border_width, self.border_width, health_w, actual_h))
 
-    #self.img.set_alpha(self.alpha) #TODO WHAT IN GODS NAME?
+    return img
 
-    screen.blit(self.img, (self.x + dx, self.y + dy))
+  def image(self):
+    return self.cache.get((self.amt, self.max_amt, self.width), self.draw, self.alpha)
 
 class PushBlock(Entity):
   def __init__(self, x, y, m):
@@ -899,17 +2191,84 @@ class PushBlock(Entity):
 
     self.visible = True
 
-    if not m.is_wall_rel(int(self.x / TILE_SIZE), int(self.y / TILE_SIZE) + 1) and Tick.get(8):
+    if not m.is_wall_rel(int(self.x / TILE_SIZE), int(self.y / TILE_SIZE) + 1) and Tick.due(8, self.uid):
       if not entities.any("enemy", lambda a: a.touches_point((self.x + 4, self.y + TILE_SIZE))):
         if not entities.any("crate", lambda a: a.uid != self.uid and a.touches_point((self.x + 1, self.y + TILE_SIZE))):
           self.move(self.x, self.y + TILE_SIZE, entities)
 
     super(PushBlock, self).update(entities)
 
+class Switchboard(Entity):
+  """ Keeps track of what's sitting on each switch in the room. Rather than
+  checking every switch against every switchpusher each frame, it only looks
+  at the things that reported a move, and only flips locks when a switch
+  actually goes up or down. A room where nothing moves costs nothing. """
+  def __init__(self):
+    super(Switchboard, self).__init__(0, 0, ["updateable", "switchboard"])
+    self.room_version = -1
+    self.switches = []
+    self.occupants = {}
+
+  def depth(self):
+    return SWITCH_DEPTH
+
+  def update(self, entities):
+    moved = entities.take_moves().values()
+
+    if self.room_version != entities.room_version:
+      # New room; start over from scratch.
+      self.room_version = entities.room_version
+      self.switches = entities.get("switch")
+      self.occupants = dict((s.uid, set()) for s in self.switches)
+
+      moved = entities.get("switchpusher") + entities.get("beam")
+      self.check_win(entities)
+    elif len(moved) == 0:
+      return
+
+    for e in moved:
+      if "beam" in e.groups:
+        self.check_win(entities)
+        break
+
+    if len(self.switches) == 0: return
+
+    for e in moved:
+      present = entities.alive(e) and "switchpusher" in e.groups
+
+      for s in self.switches:
+        if present and e.touches_rect(s):
+          self.occupants[s.uid].add(e.uid)
+
+          #save position of the block that's pushing the switch.
+          if "persistent" in e.groups:
+            # This hack prevents an unwinnable situation in room (3, 1).
+            if not (e.x == 240 and e.y ==  360 and e.restore_map_xy == (3, 1)):
+              e.restore_xy = (e.x, e.y)
+        else:
+          self.occupants[s.uid].discard(e.uid)
+
+    for s in self.switches:
+      pressed = len(self.occupants[s.uid]) > 0
+
+      if pressed and not s.pressed:
+        s.activate(entities)
+      elif s.pressed and not pressed:
+        s.deactivate(entities)
+
+  def check_win(self, entities):
+    for e in entities.get("you-win"):
+      e.check(entities)
+
 class Switch(Entity):
+  """ Asleep except while animating, which it does when the Switchboard
+  presses or releases it. """
+  sleeps = True
+
   def __init__(self, x, y, m):
-    super(Switch, self).__init__(x, y, ["renderable", "updateable", "switch", "relative"], 4, 3, "tiles.png")
+    super(Switch, self).__init__(x, y, ["renderable", "updateable", "switch", "relative", "map_element"], 4, 3, "tiles.png")
     self.restore_map_xy = m.get_mapxy()
+    self.pressed = False
 
   def depth(self):
     return SWITCH_DEPTH
@@ -924,25 +2283,32 @@ class Switch(Entity):
     super(Switch, self).update(entities)
 
   def activate(self, entities):
-    for e in entities.get("lock"):
+    self.pressed = True
+    m = entities.one("map")
+    m.touch_layout()
+    for e in m.locks:
       if "wall" in e.groups:
         e.groups.remove("wall")
-        e.animate([[0, 0]])
-        self.animate([[5, 3]])
+        e.play("lock-open")
+        self.play("switch-down")
 
   def deactivate(self, entities):
-    for e in entities.get("lock"):
+    self.pressed = False
+    m = entities.one("map")
+    m.touch_layout()
+    for e in m.locks:
       if "wall" not in e.groups:
         e.add_group("wall")
-        e.animate([[7, 2]])
-        self.animate([[4, 3]])
+        e.play("lock-shut")
+        self.play("switch-up")
 
 class YouWin(Entity):
   def __init__(self, x, y):
-    super(YouWin, self).__init__(x, y, ["renderable", "map_element", "you-win", "updateable", "relative"], 2, 1, "tiles.png")
+    super(YouWin, self).__init__(x, y, ["renderable", "map_element", "you-win", "relative"], 2, 1, "tiles.png")
     self.can_win = False
   
-  def update(self, entities):
+  # Called by the Switchboard whenever a beam light moves.
+  def check(self, entities):
     if len(entities.get("beam", "wall")) == 2 and not self.can_win:
       self.img = TileSheet.get("tiles.png", 2, 2)
       self.can_win = True
@@ -952,9 +2318,10 @@ class YouWin(Entity):
 class Reflector(Entity):
   def __init__(self, x, y, type):
     self.direction = [1, 0]
-    super(Reflector, self).__init__(x, y, ["renderable", "reflector", "relative"], 6, 0, "tiles.png")
+    super(Reflector, self).__init__(x, y, ["renderable", "reflector", "relative", "map_element"], 6, 0, "tiles.png")
 
-  def reflect(self, direction):
+  @staticmethod
+  def reflect(direction):
     return [direction[1], -direction[0]]
   
   def depth(self): return 1
@@ -1031,6 +2398,70 @@ class Pickup(Entity):
   def pickup(self, ch):
     ch.heal(3)
 
+class AIContext(object):
+  """ Everything an enemy needs to know about the world. Built once per frame
+  by EnemyAI and shared by every enemy, rather than every enemy digging
+  through the entity list on its own. """
+  def __init__(self, entities):
+    self.entities = entities
+    self.ch = entities.one("character")
+    self.m = entities.one("map")
+
+    # Walls are (nearly) always tile aligned, so most of them go in a grid.
+    # Tiles are already in one: the map's.
+    self.solid = set()
+    self.loose_walls = []
+    for e in entities.get("wall"):
+      if e.x % TILE_SIZE == 0 and e.y % TILE_SIZE == 0:
+        self.solid.add((int(e.x / TILE_SIZE), int(e.y / TILE_SIZE)))
+      else:
+        self.loose_walls.append(e)
+
+    self.crates = set((e.x, e.y) for e in entities.get("crate"))
+
+  def collides_with_wall(self, e):
+    nr = e.nicer_rect()
+
+    for i in range(int(math.floor(nr.x / TILE_SIZE)), int(math.ceil((nr.x + nr.size) / TILE_SIZE))):
+      for j in range(int(math.floor(nr.y / TILE_SIZE)), int(math.ceil((nr.y + nr.size) / TILE_SIZE))):
+        if (i, j) in self.solid or self.m.is_wall_rel(i, j): return True
+
+    for w in self.loose_walls:
+      if w.touches_rect(nr): return True
+
+    return False
+
+class EnemyAI(Entity):
+  """ Updates every enemy in the room, one strategy at a time. """
+  def __init__(self):
+    super(EnemyAI, self).__init__(0, 0, ["updateable", "enemy-ai"])
+
+  def depth(self):
+    return ENEMY_DEPTH
+
+  def update(self, entities):
+    enemies = entities.get("enemy")
+    if len(enemies) == 0: return
+
+    ctx = AIContext(entities)
+    by_strategy = {}
+
+    for e in enemies:
+      Entity.update(e, entities)
+      by_strategy.setdefault(e.type, []).append(e)
+
+    for e in by_strategy.get(Enemy.STRATEGY_STUPID, []):
+      e.be_stupid(ctx)
+
+    for e in by_strategy.get(Enemy.STRATEGY_SWEEPER, []):
+      e.be_sweeper(ctx)
+
+    Enemy.be_sentries(by_strategy.get(Enemy.STRATEGY_SENTRY, []), ctx)
+
+    for e in enemies:
+      if e.touches_rect(ctx.ch):
+        ctx.ch.hurt(1, entities)
+
 class Enemy(Entity):
   STRATEGY_STUPID = 0
   STRATEGY_SENTRY = 1
@@ -1044,28 +2475,14 @@ class Enemy(Entity):
     self.hp = Enemy.hp[self.type]
     self.ticker = 0
 
+    # Enemies aren't "updateable"; EnemyAI updates them all in one go.
     self.direction = [1, 0]
     if self.type == Enemy.STRATEGY_STUPID:
-      super(Enemy, self).__init__(x, y, ["renderable", "switchpusher", "updateable", "knocked", "enemy", "relative", "map_element"], 4, 0, "tiles.png")
-    elif self.type == Enemy.STRATEGY_SENTRY:
-      super(Enemy, self).__init__(x, y, ["renderable", "updateable", "enemy", "relative", "map_element"], 7, 1, "tiles.png")
-    elif self.type == Enemy.STRATEGY_SWEEPER:
-      super(Enemy, self).__init__(x, y, ["renderable", "updateable", "knocked", "enemy", "relative", "map_element"], 9, 1, "tiles.png")
-
-
-  def update(self, entities):
-    super(Enemy, self).update(entities)
-    ch = entities.one("character")
-
-    if self.type == Enemy.STRATEGY_STUPID:
-      self.be_stupid(entities)
+      super(Enemy, self).__init__(x, y, ["renderable", "switchpusher", "knocked", "enemy", "relative", "map_element"], 4, 0, "tiles.png")
     elif self.type == Enemy.STRATEGY_SENTRY:
-      self.be_sentry(entities, ch)
+      super(Enemy, self).__init__(x, y, ["renderable", "enemy", "relative", "map_element"], 7, 1, "tiles.png")
     elif self.type == Enemy.STRATEGY_SWEEPER:
-      self.be_sweeper(entities, ch)
-
-    if self.touches_rect(ch):
-      ch.hurt(1, entities)
+      super(Enemy, self).__init__(x, y, ["renderable", "knocked", "enemy", "relative", "map_element"], 9, 1, "tiles.png")
 
   def depth(self):
     return ENEMY_DEPTH
@@ -1090,58 +2507,75 @@ class Enemy(Entity):
 
     self.x -= dir[0]
     self.y -= dir[1]
+    entities.report_move(self)
 
-  def be_sweeper(self, entities, ch):
+  def be_sweeper(self, ctx):
+    ch = ctx.ch
     if ch.y != self.y: 
-      self.img = TileSheet.get("tiles.png", 9, 1)
+      self.img = Clips.get("sweeper-waiting").frames[0]
       return
 
-    self.img = TileSheet.get("tiles.png", 9, 0)
-    m = entities.one("map")
+    self.img = Clips.get("sweeper-charging").frames[0]
 
     amount = 6
     dx = sign(ch.x - self.x)
-    while not self.collides_with_wall(entities) and amount > 0:
+    while not ctx.collides_with_wall(self) and amount > 0:
       self.x += dx
       amount -= 1
     self.x -= dx
 
-  def be_sentry(self, entities, ch):
-    if Tick.get(20):
-      self.ticker += 1
-      self.img = TileSheet.get("tiles.png", 7 + self.ticker % 2, 1)
-
-    if Tick.get(20):
-      spd = 1
-      mag = math.sqrt((self.x - ch.x) ** 2 + (self.y - ch.y) ** 2)
-      if mag == 0: return
-      direct = (spd * (ch.x - self.x) / mag, spd * (ch.y - self.y) / mag)
-      b = Bullet(self, direct, 1)
-      if not DEBUG: shoot_sound.play()
-      entities.add(b)
+  @staticmethod
+  def be_sentries(sentries, ctx):
+    if len(sentries) == 0 or not Tick.due(20): return
+
+    # Every sentry blinks and shoots in step, so they share one cadence;
+    # ticker is how far through the clip each one is.
+    clip = Clips.get("sentry")
+    for s in sentries:
+      s.ticker = clip.after(s.ticker)
+      s.img = clip.frames[s.ticker]
+
+    # Aim every sentry at once. numpy takes a while to import, and sentries
+    # are rare, so it's only imported once there are some.
+    import numpy
+
+    ch = ctx.ch
+    delta = numpy.array([(ch.x - s.x, ch.y - s.y) for s in sentries], dtype=float)
+    mag = numpy.hypot(delta[:, 0], delta[:, 1])
+
+    for s, (dx, dy), d in zip(sentries, delta, mag):
+      if d == 0: continue
+      b = Bullet(s, (float(dx / d), float(dy / d)), 1)
+      sfx.play("shoot")
+      ctx.entities.add(b)
   
-  def be_stupid(self, entities):
-    m = entities.one("map")
+  def be_stupid(self, ctx):
+    m = ctx.m
 
     if not m.is_wall_rel(int(self.x / TILE_SIZE), int(self.y / TILE_SIZE) + 1) and \
         not m.is_wall_rel(int((self.x + TILE_SIZE - 1)/TILE_SIZE), int(self.y / TILE_SIZE) + 1):
-      if not entities.any("crate", lambda e: e.x == self.x and e.y == self.y + TILE_SIZE):
-        if Tick.get(8):
-          self.move(self.x, self.y + TILE_SIZE, entities)
+      if (self.x, self.y + TILE_SIZE) not in ctx.crates:
+        if Tick.due(8, self.uid):
+          self.move(self.x, self.y + TILE_SIZE, ctx.entities)
         return
 
     self.x += self.direction[0]
     self.y += self.direction[1]
 
-    if self.collides_with_wall(entities):
+    if ctx.collides_with_wall(self):
       self.direction[0] *= -1
       self.direction[1] *= -1
 
+    ctx.entities.report_move(self)
+
 class LightSource(Entity):
   BEAM = 0
   RADIAL = 1
   BEAM_LEFT = 2
 
+  INTENSITY = -255
+  FALLOFF = 60
+
   def __init__(self, x, y, entities, m, light_type, dir=None):
     if light_type != LightSource.RADIAL and dir is None:
       if light_type == LightSource.BEAM:
@@ -1153,9 +2587,8 @@ class LightSource(Entity):
 
     self.light_type = light_type
 
-    self.intensity = -255
-    self.falloff = 60
-    self.lightbeampos = []
+    self.intensity = LightSource.INTENSITY
+    self.falloff = LightSource.FALLOFF
 
     if light_type == LightSource.BEAM:
       super(LightSource, self).__init__(x, y, ["switchpusher", "wall", "pushable", "renderable", "relative", "updateable", "persistent", "light-source", "beam"], 5, 0, "tiles.png")
@@ -1172,40 +2605,16 @@ class LightSource(Entity):
     assert(self.x % TILE_SIZE == 0)
     assert(self.y % TILE_SIZE == 0)
 
-  def calculate_light_deltas(self, entities, m):
+  def light_state(self):
+    """ What a LightingJob needs to know about this light. Beams grow by one
+    tile every time this is called. """
+    if not self.visible: return None
+
     if self.light_type == LightSource.BEAM:
       self.beamtick += 1
-      return self.beam_deltas(entities, m)
-    elif self.light_type == LightSource.RADIAL:
-      return self.radial_deltas(entities, m)
+      return (self.uid, self.light_type, self.x, self.y, self.direction, self.beamtick, self.intensity, self.falloff)
 
-  def radial_deltas(self, entities, m):
-    radius = 500
-    pts = []
-    deltas = [[0 for x in range(MAP_SIZE_TILES)] for y in range(MAP_SIZE_TILES)]
-
-    if not self.visible: return deltas
-
-    for x in range(self.x - radius, self.x + radius + 1, TILE_SIZE):
-      for y in range(self.y - radius, self.y + radius + 1, TILE_SIZE):
-        if x == self.x - radius or x == self.x + radius or y == self.y - radius or y == self.y + radius:
-          pts.append((x, y))
-
-    for x, y in pts:
-      pt = [self.x, self.y]
-
-      #raycast to (x, y) and light up everything along the way.
-      dx = (x - self.x) * TILE_SIZE / radius
-      dy = (y - self.y) * TILE_SIZE / radius
-
-      for i in range(radius):
-        if not m.in_bounds((pt[0], pt[1])): break
-        if m.is_opaq_rel(int(pt[0] / 20), int(pt[1] / 20)): break
-        deltas[int(pt[0] / 20)][int(pt[1] / 20)] = self.intensity #* (1 - (i + 20) / (radius + 20))
-        pt[0] = pt[0] + dx
-        pt[1] = pt[1] + dy
-
-    return deltas
+    return (self.uid, self.light_type, self.x, self.y, None, 0, self.intensity, self.falloff)
 
   def update(self, entities):
     m = entities.one("map")
@@ -1221,54 +2630,9 @@ class LightSource(Entity):
       self.restore_xy = (self.x, self.y)
       self.restore_map_xy = m.get_mapxy()
 
-    if not m.is_wall_rel(int(self.x / TILE_SIZE), int(self.y / TILE_SIZE) + 1) and Tick.get(3):
+    if not m.is_wall_rel(int(self.x / TILE_SIZE), int(self.y / TILE_SIZE) + 1) and Tick.due(3, self.uid):
       self.move(self.x, self.y + TILE_SIZE, entities)
 
-  def light_beam_pos(self):
-    return self.lightbeampos
-
-  def beam_deltas(self, entities, m):
-    self.lightbeampos = []
-    deltas = [[0 for x in range(MAP_SIZE_TILES)] for y in range(MAP_SIZE_TILES)]
-
-    if not self.visible: return deltas
-
-    pos_abs = [self.x, self.y]
-    pos_rel = [int(self.x / TILE_SIZE), int(self.y / TILE_SIZE)]
-    cur_dir = self.direction
-
-    length = 0
-    while m.in_bounds(pos_abs) and not m.is_opaq_rel(pos_rel[0], pos_rel[1]):
-      length += 1
-      if length > self.beamtick: break
-      # bugginess of this line approaches 1...
-      deltas[pos_rel[0]][pos_rel[1]] = self.intensity
-      self.lightbeampos.append((pos_abs[0], pos_abs[1]))
-
-      # radial lighting
-      radius = int(math.ceil(- self.intensity / self.falloff))
-
-      for x in range(pos_rel[0] - radius, pos_rel[0] + radius + 1):
-        for y in range(pos_rel[1] - radius, pos_rel[1] + radius + 1):
-          if m.in_bounds((x * TILE_SIZE, y * TILE_SIZE)):
-            point_intensity = -max(0, 255 - (abs(x - pos_rel[0]) + abs(y - pos_rel[1])) * self.falloff)
-            deltas[x][y] += point_intensity
-
-      if cur_dir[0] == 0 and cur_dir[1] == 0: break
-
-      reflectors = entities.get("reflector", lambda e: e.x == pos_abs[0] and e.y == pos_abs[1])
-
-      if len(reflectors) > 0:
-        cur_dir = reflectors[0].reflect(cur_dir)
-
-      pos_abs[0] += cur_dir[0] * TILE_SIZE
-      pos_abs[1] += cur_dir[1] * TILE_SIZE
-
-      pos_rel[0] += cur_dir[0]
-      pos_rel[1] += cur_dir[1]
-
-    return deltas
-
   def depth(self):
     return LIGHT_SOURCE_DEPTH
 
@@ -1300,15 +2664,14 @@ class Bullet(Entity):
 
   def die(self):
     self.dying = True
-    self.ticks = 0
+    self.play("bullet-pop")
 
   def death_anim(self, entities):
-    if Tick.get(5):
-      self.ticks += 1
-      if self.ticks == 3:
-        entities.remove(self)
-      else:
-        self.img = TileSheet.get("tiles.png", 3, self.ticks)
+    # Gone once the last frame has been up as long as the others were.
+    if self.clip is not None:
+      self.step()
+    elif Tick.due(Clips.get("bullet-pop").ticks, self.uid):
+      entities.remove(self)
 
   def update(self, entities):
     if self.dying:
@@ -1326,7 +2689,8 @@ class Bullet(Entity):
 
     hitlambda = lambda x: x.touches_point((self.x + self.size/2, self.y + self.size/2))
 
-    walls_hit = entities.get("wall", hitlambda)
+    center = (self.x + self.size/2, self.y + self.size/2)
+    walls_hit = entities.one("map").walls(entities, center[0], center[1], center[0], center[1], hitlambda)
     if len(walls_hit) > 0:
       self.die()
       return
@@ -1373,6 +2737,9 @@ class Character(Entity):
     entities.add(self.sanity_bar)
     self.sanity_bar.visible = False
 
+    self.hud = Hud([self.hp_bar, self.sanity_bar])
+    entities.add(self.hud)
+
   def die(self, entities):
     self.hp = self.max_hp
     self.zoom(self.last_safe_place, self.last_safe_room, entities)
@@ -1410,25 +2777,26 @@ class Character(Entity):
 
   def check_new_map(self, entities):
     m = entities.one("map")
+    width, height = m.pixel_size()
     d = (0, 0)
 
-    if self.x + self.size > MAP_SIZE_PIXELS: d = (1, 0)
+    if self.x + self.size > width: d = (1, 0)
     if self.x < 0: d = (-1, 0)
-    if self.y + self.size > MAP_SIZE_PIXELS: d = (0, 1)
+    if self.y + self.size > height: d = (0, 1)
     if self.y < 0: d = (0, -1)
 
     if d != (0, 0):
       m.new_map_rel(entities, *d)
 
-      self.x -= (MAP_SIZE_PIXELS - TILE_SIZE) * d[0]
-      self.y -= (MAP_SIZE_PIXELS - TILE_SIZE) * d[1]
+      self.x -= (width - TILE_SIZE) * d[0]
+      self.y -= (height - TILE_SIZE) * d[1]
 
       # Force instant camera update.
       global cam_lag_override
       cam_lag_override = 1
 
   def shoot_bullet(self, entities):
-    if not DEBUG: shoot_sound.play()
+    sfx.play("shoot")
     b = Bullet(self, self.direction, 1)
     entities.add(b)
 
@@ -1472,6 +2840,7 @@ class Character(Entity):
   def update(self, entities):
     self.x = int(self.x)
     self.y = int(self.y)
+    old_xy = (self.x, self.y)
 
     can_update = super(Character, self).update(entities)
     self.check_win(entities)
@@ -1483,27 +2852,28 @@ class Character(Entity):
     dx, dy = (int(self.vx/2), 0)
     self.vx = int(self.vx/2)
 
-    if UpKeys.key_down(pygame.K_x) and Tick.get(self.cooldown): self.shoot_bullet(entities)
+    if UpKeys.key_down(pygame.K_x) and Tick.due(self.cooldown, self.uid): self.shoot_bullet(entities)
     if UpKeys.key_down(pygame.K_LEFT):
       dx -= self.speed
       self.direction = (-1, 0)
-      if Tick.get(8): self.animticker = (self.animticker + 1) % 4
-      self.img = TileSheet.get("tiles.png", self.animticker, 4)
+      walk = Clips.get("walk-left")
+      if Tick.due(walk.ticks, self.uid): self.animticker = walk.after(self.animticker)
+      self.img = walk.frames[self.animticker]
       self.vx = dx
 
     if UpKeys.key_down(pygame.K_RIGHT):
       dx += self.speed
       self.direction = (1, 0)
-      if Tick.get(8): self.animticker = (self.animticker + 1) % 4
-      self.img = TileSheet.get("tiles.png", self.animticker, 3)
+      walk = Clips.get("walk-right")
+      if Tick.due(walk.ticks, self.uid): self.animticker = walk.after(self.animticker)
+      self.img = walk.frames[self.animticker]
       self.vx = dx
 
     if UpKeys.key_down(pygame.K_UP):
       self.direction = (0, -1)
     if UpKeys.key_down(pygame.K_SPACE) and self.onground: 
       self.vy = 14
-      if not DEBUG:
-        jump_sound.play()
+      sfx.play("jump")
 
     self.vy -= GRAVITY
     dy -= self.vy
@@ -1528,8 +2898,9 @@ class Character(Entity):
 
     self.onground = False
 
+    m = entities.one("map")
     for p in zip(range(self.x + 2, self.x + self.size - 2), [self.y + self.size + 1] * self.size):
-      if entities.any("wall", lambda x: x.touches_point(p)):
+      if len(m.walls(entities, p[0], p[1], p[0], p[1], lambda x: x.touches_point(p))) > 0:
         self.onground = True
         break
 
@@ -1537,11 +2908,14 @@ class Character(Entity):
       dy = 0
       self.vy = 0
 
-      if not DEBUG and not oldOG: land_sound.play()
+      if not oldOG: sfx.play("land")
 
     self.check_new_map(entities)
     self.check_sanity(entities)
 
+    if (self.x, self.y) != old_xy:
+      entities.report_move(self)
+
   def soft_death(self, entities):
     self.fadein()
 
@@ -1568,7 +2942,7 @@ class Character(Entity):
       going_insane = False
 
       if self.sanity < self.max_sanity:
-        if Tick.get(6): 
+        if Tick.due(6, self.uid):
           self.sanity += 1
           self.sanity_bar.jiggling = 0
       return
@@ -1576,22 +2950,25 @@ class Character(Entity):
     global going_insane
     going_insane = True
 
-    if Tick.get(20): 
+    if Tick.due(20, self.uid):
       self.sanity -= 1
       self.sanity_bar.jiggling = 20
 
     if self.sanity <= 0:
       self.soft_death(entities)
 
-def render_all(buff, manager, lag = CAM_LAG):
+def camera(manager, lag = CAM_LAG):
+  """ Eases the camera towards the character. Returns how far to shift
+  "relative" entities when drawing them. """
   global cam_lag_override
   if cam_lag_override != 0:
     lag = cam_lag_override
     cam_lag_override = 0
 
   ch = manager.one("character")
-  x_ofs_actual = max(min(ch.x, 400 - CHAR_XY), CHAR_XY)
-  y_ofs_actual = max(min(ch.y, 400 - CHAR_XY), CHAR_XY)
+  width, height = manager.one("map").pixel_size()
+  x_ofs_actual = max(min(ch.x, width - CHAR_XY), CHAR_XY)
+  y_ofs_actual = max(min(ch.y, height - CHAR_XY), CHAR_XY)
 
   x_ofs = render_all.old_xofs + (x_ofs_actual - render_all.old_xofs) / lag
   y_ofs = render_all.old_yofs + (y_ofs_actual - render_all.old_yofs) / lag
@@ -1599,100 +2976,375 @@ def render_all(buff, manager, lag = CAM_LAG):
   render_all.old_xofs = x_ofs
   render_all.old_yofs = y_ofs
 
+  return CHAR_XY-x_ofs, CHAR_XY-y_ofs
+
+def offset(e, dx, dy):
+  if "relative" in e.groups:
+    return dx, dy
+  return 0, 0
+
+class RenderStats:
+  """ How many entities the last frame drew, and how many were off screen. """
+  rendered = 0
+  culled = 0
+
+def visible(manager, dx, dy):
+  """ Everything on screen with the camera at dx, dy, in the order it's
+  drawn in: the map's tiles, then the renderables by depth. """
+  m = manager.one("map")
+  view = pygame.Rect(0, 0, WIDTH, HEIGHT)
+
+  left = max(0, int(math.floor(-dx / TILE_SIZE)))
+  right = min(m.width, int(math.ceil((WIDTH - dx) / TILE_SIZE)))
+  top = max(0, int(math.floor(-dy / TILE_SIZE)))
+  bottom = min(m.height, int(math.ceil((HEIGHT - dy) / TILE_SIZE)))
+
+  shown = [m.tiles[i][j] for i in range(left, right) for j in range(top, bottom)]
+  culled = m.width * m.height - len(shown)
+
   for e in sorted(manager.get("renderable"), key=lambda x: x.depth()):
-    if "relative" in e.groups:
-      e.render(buff, CHAR_XY-x_ofs, CHAR_XY-y_ofs)
+    if e.screen_rect(*offset(e, dx, dy)).colliderect(view):
+      shown.append(e)
     else:
-      e.render(buff, 0, 0)
+      culled += 1
+
+  RenderStats.rendered = len(shown)
+  RenderStats.culled = culled
+
+  return shown
+
+def render_all(buff, manager, lag = CAM_LAG):
+  dx, dy = camera(manager, lag)
+
+  for e in visible(manager, dx, dy):
+    e.render(buff, *offset(e, dx, dy))
 
 render_all.old_xofs = 40
 render_all.old_yofs = 40
 
+class DirtyRenderer(object):
+  """ Renders a frame by redrawing only what changed since the last one.
+
+  Every visible entity says where it draws and what it looks like. Where
+  either changed, the old and new rects get redrawn, with everything that
+  overlaps them, in depth order. The lightmap covers the whole room, so a
+  scrolling camera or a new lightmap still redraws everything. """
+  def __init__(self, presenter):
+    self.presenter = presenter
+    self.drawn = {}
+    self.bounds = presenter.buff.get_rect()
+
+  def render(self, manager, lag = CAM_LAG):
+    buff = self.presenter.buff
+    dx, dy = camera(manager, lag)
+    renderables = visible(manager, dx, dy)
+
+    drawn = {}
+    for e in renderables:
+      drawn[e.uid] = (e.screen_rect(*offset(e, dx, dy)), e.appearance())
+
+    dirty = []
+    for uid, now in drawn.iteritems():
+      before = self.drawn.get(uid)
+      if before != now:
+        dirty.append(now[0])
+        if before is not None: dirty.append(before[0])
+
+    for uid, before in self.drawn.iteritems():
+      if uid not in drawn:
+        dirty.append(before[0])
+
+    self.drawn = drawn
+
+    dirty = [rect.clip(self.bounds) for rect in dirty]
+    dirty = [rect for rect in dirty if rect.width > 0 and rect.height > 0]
+
+    if len(dirty) == 0: return
+
+    if any(rect == self.bounds for rect in dirty):
+      for e in renderables:
+        e.render(buff, *offset(e, dx, dy))
+
+      self.presenter.present()
+      return
+
+    for rect in dirty:
+      buff.set_clip(rect)
+      for e in renderables:
+        if drawn[e.uid][0].colliderect(rect):
+          e.render(buff, *offset(e, dx, dy))
+
+    buff.set_clip(None)
+    self.presenter.present(dirty)
+
+class Presenter(object):
+  """ Owns the window. The game renders into buff, which is always WIDTH x
+  HEIGHT, and present() blows it up onto the screen by a whole number.
+
+  The scaling goes straight into the window surface, so there's no
+  intermediate surface per frame. With use_scaled, SDL does the scaling
+  itself (pygame 2 only) and buff is the window. """
+  def __init__(self, scale=2, use_scaled=False):
+    if scale < 1 or int(scale) != scale:
+      raise ValueError("Scale must be a whole number, got %s" % scale)
+
+    self.scale = int(scale)
+    self.scaled = use_scaled and hasattr(pygame, "SCALED")
+
+    if self.scaled:
+      self.screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.SCALED)
+      self.buff = self.screen
+    else:
+      self.screen = pygame.display.set_mode((WIDTH * self.scale, HEIGHT * self.scale))
+
+      # transform.scale only scales into a surface of the same format.
+      self.buff = pygame.Surface((WIDTH, HEIGHT), 0, self.screen)
+
+  def present(self, rects=None):
+    """ Show the whole of buff, or just rects of it. """
+    if rects is None:
+      if self.buff is not self.screen:
+        if self.scale == 1:
+          self.screen.blit(self.buff, (0, 0))
+        else:
+          pygame.transform.scale(self.buff, self.screen.get_size(), self.screen)
+
+      pygame.display.flip()
+      return
+
+    if self.buff is not self.screen:
+      scaled = []
+      for rect in rects:
+        dest = pygame.Rect(rect.x * self.scale, rect.y * self.scale, rect.width * self.scale, rect.height * self.scale)
+        if self.scale == 1:
+          self.screen.blit(self.buff, dest, rect)
+        else:
+          pygame.transform.scale(self.buff.subsurface(rect), dest.size, self.screen.subsurface(dest))
+        scaled.append(dest)
+      rects = scaled
+
+    pygame.display.update(rects)
+
 def main():
+  replay = None
+  if REPLAY_FILE is not None:
+    replay = Replay.load(REPLAY_FILE)
+  elif RECORD_FILE is not None:
+    replay = Replay.record(RECORD_FILE)
+
+  if replay is not None:
+    random.seed(replay.seed)
+
+  trace = None
+  if TRACE_FILE is not None:
+    trace = open(TRACE_FILE, "w")
+    trace.write("tick,update_ms,light_ms,render_ms,rendered,culled\n")
+
+  try:
+    run_game(replay, trace)
+  finally:
+    if replay is not None: replay.close()
+    if trace is not None: trace.close()
+
+def new_world(room):
+  """ A fresh game, with the character in room. """
+  # Anything still waiting to wake up belongs to some earlier world.
+  Tick.clear()
+  Scheduler.take()
+
   manager = Entities()
   c = Character(40, 40, manager)
   manager.add(c)
 
   manager.add(Light())
   manager.add(Particles())
+  manager.add(EnemyAI())
+  manager.add(Switchboard())
 
   m = Map()
-  if DEBUG:
-    m.new_map_abs(manager, 5, 3)
-  else:
-    m.new_map_abs(manager, 0, 0)
-
+  m.new_map_abs(manager, *room)
   manager.add(m)
 
+  return manager
+
+def end_world(manager):
+  """ Stop everything a world from new_world() has going in the background.
+  It has to happen before pygame.quit(), which they'd otherwise carry on
+  using. Doing it twice is fine. """
+  manager.one("all-lights").stop()
+
+def required_assets(soundtrack):
+  """ Everything the game will want from the disk once it's going. """
+  needed = assets.Assets()
+
+  needed.add(TileSheet.add, "tiles.png")
+  needed.add(Clips.load)
+  needed.add(Fonts.add, TEXT_SIZE)
+  needed.add(Map.preload)
+
+  if soundtrack is not None:
+    needed.add(soundtrack.preload)
+    needed.add(sfx.load, SOUNDS)
+
+  return needed
+
+def loading_screen(needed):
+  """ Load needed on a background thread, with a progress bar going in the
+  meantime. """
+  buff = presenter.buff
+  clock = pygame.time.Clock()
+  frame = 0
+
+  needed.start()
+
+  while not needed.finished():
+    for event in pygame.event.get():
+      if event.type == pygame.QUIT:
+        pygame.quit()
+        sys.exit()
+
+    buff.fill((0, 0, 0))
+
+    bar = pygame.Rect(0, 0, WIDTH * 2 // 3, 6)
+    bar.center = (WIDTH // 2, HEIGHT // 2)
+    pygame.draw.rect(buff, (80, 80, 80), bar, 1)
+    pygame.draw.rect(buff, (255, 255, 255), (bar.x, bar.y, int(bar.width * needed.progress()), bar.height))
+
+    # Something that moves, even while one big file takes a while.
+    for i in range(3):
+      shade = 255 if (frame // 10) % 3 == i else 80
+      buff.fill((shade, shade, shade), (WIDTH // 2 - 10 + i * 8, bar.bottom + 10, 4, 4))
+
+    presenter.present()
+    clock.tick(60)
+    frame += 1
+
+  needed.wait()
+
+  # The game doesn't draw over the bits of the screen its room doesn't
+  # cover, so don't leave the bar there.
+  buff.fill((0, 0, 0))
+
+def run_game(replay, trace):
   pygame.display.init()
   pygame.font.init()
 
-  normal_sound = None
-  dark_sound = None
+  soundtrack = None
 
-  buff = pygame.Surface((300, 300))
-
-  if not DEBUG:
+  # Headless runs are for replays and benchmarks. Nobody's listening.
+  if not DEBUG and not HEADLESS:
     pygame.mixer.init(frequency=22050, size=-16, channels=2, buffer=1024)
+    soundtrack = audio.Soundtrack(*SOUNDTRACK_FILES)
+
+  # Read everything in now, so nothing waits on the disk mid game. Without
+  # anything to watch, there's no point in a loading screen.
+  needed = required_assets(soundtrack)
+  if HEADLESS or NO_RENDER:
+    needed.load()
+  else:
+    loading_screen(needed)
+
+  if DEBUG:
+    manager = new_world((5, 3))
+  else:
+    manager = new_world((0, 0))
+
+  try:
+    play(manager, replay, trace, soundtrack)
+  finally:
+    end_world(manager)
+    if soundtrack is not None: soundtrack.stop()
 
-    normal_sound = pygame.mixer.Sound('soundtrack-normal.ogg')
-    dark_sound   = pygame.mixer.Sound('soundtrack-dark.ogg')
+def step(manager, buff, dirty_renderer=None, presenter=None):
+  """ Everything a frame does once the input is in: update whatever's awake,
+  relight now and then, and draw into buff, or through dirty_renderer. With
+  a presenter, buff is its buff and the frame goes on the screen too.
+  Returns how long updating, lighting and rendering took, in seconds. """
+  update_start = time.time()
 
-    normal_sound.play(-1)
+  #TODO: Better is a updateDepth() on each entity.
+  for e in manager.updating():
+    e.update(manager)
 
-    dark_sound.play(-1)
-    dark_sound.set_volume(0.0)
+  # Nobody is iterating over the entity list now, so it's safe to sweep.
+  manager.compact()
 
-    global land_sound
-    land_sound = pygame.mixer.Sound("land.wav")
+  light_start = time.time()
 
-    global jump_sound
-    jump_sound = pygame.mixer.Sound("jump.wav")
+  if Tick.due(10):
+    manager.one("all-lights").recalculate_light(manager, manager.one("map"))
 
-    global shoot_sound
-    shoot_sound = pygame.mixer.Sound("shoot.wav")
-    shoot_sound.set_volume(0.2)
+  sfx.update()
+
+  render_start = time.time()
+
+  if not NO_RENDER:
+    if dirty_renderer is not None:
+      dirty_renderer.render(manager)
+    else:
+      render_all(buff, manager)
+
+      if presenter is not None:
+        presenter.present()
+
+  end = time.time()
+  return light_start - update_start, render_start - light_start, end - render_start
+
+def play(manager, replay, trace, soundtrack):
+  """ The game loop. Returns when the game is won, or the replay is over. """
+  buff = presenter.buff
+  dirty_renderer = None
+  if DIRTY_RECTS:
+    dirty_renderer = DirtyRenderer(presenter)
+
+  if soundtrack is not None:
+    soundtrack.start()
 
   while you_win_override:
-    if not DEBUG:
-      if going_insane:
-        if normal_sound.get_volume() > 0.1:
-          normal_sound.set_volume(normal_sound.get_volume() - CROSSFADE_SPEED)
-          dark_sound.set_volume(1 - normal_sound.get_volume())
-      else:
-        if dark_sound.get_volume() > 0.1:
-          normal_sound.set_volume(normal_sound.get_volume() + CROSSFADE_SPEED)
-          dark_sound.set_volume(1 - normal_sound.get_volume())
+    if soundtrack is not None:
+      soundtrack.set_dark(going_insane)
 
     Tick.inc()
 
+    events = []
     for event in pygame.event.get():
-      UpKeys.flush()
       if event.type == pygame.QUIT:
+        end_world(manager)
+        if soundtrack is not None: soundtrack.stop()
         pygame.quit()
         sys.exit()
       if event.type == pygame.KEYDOWN:
-        UpKeys.add_key(event.key)
-      if event.type == pygame.KEYUP:
-        UpKeys.release_key(event.key)
+        events.append((Replay.KEYDOWN, event.key))
+      elif event.type == pygame.KEYUP:
+        events.append((Replay.KEYUP, event.key))
+
+    if REPLAY_FILE is not None:
+      if replay.finished(Tick.tick): return
+      events = replay.get(Tick.tick)
+    elif replay is not None:
+      replay.add(Tick.tick, events)
+
+    UpKeys.flush()
+    for kind, key in events:
+      if kind == Replay.KEYDOWN:
+        UpKeys.add_key(key)
+      if kind == Replay.KEYUP:
+        UpKeys.release_key(key)
 
     if UpKeys.key_down(pygame.K_w) and UpKeys.key_down(310): # Q and CMD
       sys.exit()
 
-    #TODO: Better is a updateDepth() on each entity.
-    for e in sorted(manager.get("updateable"), key=lambda x: x.depth()):
-      e.update(manager)
-
-    if Tick.get(10):
-      manager.one("all-lights").recalculate_light(manager, manager.one("map"))
+    if UpKeys.key_up(pygame.K_F5):
+      WorldSnapshot(manager).save(QUICKSAVE_FILE)
 
-    screen.fill((0, 0, 0))
+    # Without a quicksave, there's nothing to go back to.
+    if UpKeys.key_up(pygame.K_F9):
+      WorldSnapshot.load(QUICKSAVE_FILE, manager)
 
-    render_all(buff, manager)
+    update, light, render = step(manager, buff, dirty_renderer, presenter)
 
-    screen.blit(pygame.transform.scale(buff, (300 * 2, 300 * 2)), buff.get_rect())
-
-    pygame.display.flip()
+    if trace is not None:
+      trace.write("%d,%.3f,%.3f,%.3f,%d,%d\n" % (Tick.tick, update * 1000, light * 1000, render * 1000, RenderStats.rendered, RenderStats.culled))
 
 def youwin():
   while True:
@@ -1704,8 +3356,7 @@ def youwin():
     YOU WIN!
     """
 
-    pygame.font.init()
-    my_font = pygame.font.Font("nokiafc22.ttf", 12)
+    my_font = Fonts.get(TEXT_SIZE)
     my_rect = pygame.Rect((0, 0, 300, 300))
     my_rect.x = 0
     my_rect.y = 50
@@ -1717,6 +3368,55 @@ def youwin():
 
     pygame.display.flip()
 
-#cProfile.run('main()')
-main()
-youwin()
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Ludum Dare 23.")
+  parser.add_argument("--record", metavar="FILE", help="record all input to FILE")
+  parser.add_argument("--replay", metavar="FILE", help="play back input recorded with --record")
+  parser.add_argument("--headless", action="store_true", help="don't open a window or play sound")
+  parser.add_argument("--no-render", action="store_true", help="don't render anything")
+  parser.add_argument("--trace", metavar="FILE", help="write per-tick update/light/render times to FILE")
+  parser.add_argument("--scale", type=int, default=SCALE, help="blow the %dx%d screen up this many times (default %d)" % (WIDTH, HEIGHT, SCALE))
+  parser.add_argument("--scaled", action="store_true", help="let SDL scale the screen to fit the window, if it can")
+  parser.add_argument("--dirty-rects", action="store_true", help="only redraw the parts of the screen that changed")
+  parser.add_argument("--profile", metavar="FILE", help="profile the game and write the stats to FILE")
+
+  # py2app likes to pass extra arguments. Ignore them.
+  return parser.parse_known_args(argv)[0]
+
+def start(argv):
+  """ Play the game, with command line arguments argv. Nothing happens when
+  main.py is imported, not even a window, until this is called. """
+  global HEADLESS, NO_RENDER, RECORD_FILE, REPLAY_FILE, TRACE_FILE, PROFILE_FILE, SCALE, USE_SCALED, DIRTY_RECTS
+  global presenter, screen
+
+  args = parse_args(argv)
+
+  HEADLESS = args.headless
+  NO_RENDER = args.no_render
+  RECORD_FILE = args.record
+  REPLAY_FILE = args.replay
+  TRACE_FILE = args.trace
+  PROFILE_FILE = args.profile
+  SCALE = args.scale
+  USE_SCALED = args.scaled
+  DIRTY_RECTS = args.dirty_rects
+
+  if HEADLESS:
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+  presenter = Presenter(SCALE, USE_SCALED)
+  screen = presenter.screen
+
+  if PROFILE_FILE is not None:
+    import cProfile
+    cProfile.runctx("main()", globals(), locals(), PROFILE_FILE)
+  else:
+    main()
+
+  # A replay is over once it runs out of input, whether or not anybody won.
+  if REPLAY_FILE is None:
+    youwin()
+
+if __name__ == "__main__":
+  start(sys.argv[1:])
@@ -0,0 +1,193 @@
+"""
+Stress rooms: made up rooms with as many enemies, lights, reflectors,
+crates and bullets as you like, for finding out how the game scales.
+
+The rooms go through the same Map.new_map_abs path as the real ones, as
+compiled rooms in a level.Rooms. Bullets don't come out of rooms, so the
+runner keeps the room topped up with them instead.
+
+Usage:
+    python stress.py [--frames N] [--profile] [dimension ...]
+
+Scales each dimension in turn (enemies, beams, radials, reflectors, crates,
+bullets, size) with the rest left at BASELINE, and prints the update,
+lighting and render time per frame. The last column is what each extra
+thing costs on top of the first row; if it keeps going up, that dimension
+is worse than linear. With --profile, the biggest run of each dimension
+gets profiled too.
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import random
+import argparse
+import cProfile
+import pstats
+import pygame
+import level
+
+BASELINE = { "size": 40
+           , "enemies": 3
+           , "beams": 2
+           , "radials": 2
+           , "reflectors": 4
+           , "crates": 4
+           , "bullets": 4
+           }
+
+SCALES = { "size": (20, 40, 80, 160)
+         , "enemies": (3, 12, 48, 96)
+         , "beams": (2, 8, 32, 64)
+         , "radials": (2, 8, 32, 64)
+         , "reflectors": (4, 16, 64, 128)
+         , "crates": (4, 16, 64, 128)
+         , "bullets": (4, 16, 64, 128)
+         }
+
+DIMENSIONS = ["enemies", "beams", "radials", "reflectors", "crates", "bullets", "size"]
+
+# Where the character starts, which is kept clear.
+START = (2, 2)
+
+def layout(size):
+  """ The tiles of a size x size room: walls round the edge, and ledges with
+  gaps in every sixth row. Compiled, column by column. """
+  import main
+
+  tiles = []
+  for i in range(size):
+    for j in range(size):
+      if i in (0, size - 1) or j in (0, size - 1):
+        tiles.append(main.TILE_DIRT_TOP)
+      elif j % 6 == 5 and i % 8 != 4:
+        tiles.append(main.TILE_DIRT_TOP)
+      else:
+        tiles.append(main.TILE_FLOOR)
+
+  return tiles
+
+def stress_room(size=40, enemies=0, beams=0, radials=0, reflectors=0, crates=0, seed=0):
+  """ A compiled room with the given number of each thing, scattered over
+  the empty tiles. Enemies are split evenly between the three strategies,
+  and beams between the two directions. """
+  import main
+
+  tiles = layout(size)
+  rand = random.Random(seed)
+
+  empty = [(i, j) for i in range(size) for j in range(size) if tiles[i * size + j] == main.TILE_FLOOR]
+  empty = [(i, j) for i, j in empty if abs(i - START[0]) > 1 or abs(j - START[1]) > 1]
+  rand.shuffle(empty)
+
+  kinds = []
+  kinds += [(main.SPAWN_STUPID, main.SPAWN_SENTRY, main.SPAWN_SWEEPER)[n % 3] for n in range(enemies)]
+  kinds += [(main.SPAWN_BEAM, main.SPAWN_BEAM_LEFT)[n % 2] for n in range(beams)]
+  kinds += [main.SPAWN_RADIAL] * radials
+  kinds += [main.SPAWN_REFLECTOR] * reflectors
+  kinds += [main.SPAWN_PUSH_BLOCK] * crates
+
+  if len(kinds) > len(empty):
+    raise ValueError("Can't fit %d things in a %dx%d room" % (len(kinds), size, size))
+
+  spawns = [(kind, i, j) for kind, (i, j) in zip(kinds, empty)]
+
+  return size, size, tiles, spawns
+
+def top_up_bullets(manager, count, rand):
+  """ Fire bullets from random spots until there are count of them. They're
+  fired by nobody in particular, so they can hit the character but not the
+  enemies. """
+  import main
+
+  m = manager.one("map")
+  missing = count - len(manager.get("bullet"))
+
+  for n in range(missing):
+    owner = main.Entity(rand.randrange(1, m.width - 1) * main.TILE_SIZE, rand.randrange(1, m.height - 1) * main.TILE_SIZE, [])
+    direction = rand.choice([(1, 0), (-1, 0), (0, 1), (0, -1)])
+    manager.add(main.Bullet(owner, direction, 1))
+
+def run(frames=200, bullets=0, seed=0, **room):
+  """ Play a stress room for a while with the character walking right.
+  Returns the average (update, lighting, render) time per frame, in ms. """
+  import main
+
+  # On the worker thread, lighting would look free.
+  main.THREADED_LIGHTING = False
+  main.Map.level = level.Rooms({ (0, 0): stress_room(seed=seed, **room) })
+  main.Map.baked = {}
+
+  random.seed(seed)
+  rand = random.Random(seed)
+  buff = pygame.Surface((main.WIDTH, main.HEIGHT))
+
+  manager = main.new_world((0, 0))
+  ch = manager.one("character")
+  main.UpKeys.add_key(pygame.K_RIGHT)
+
+  update = light = render = 0.0
+  for i in range(frames):
+    main.Tick.inc()
+    main.UpKeys.flush()
+
+    # Dying would send us back to the start of the room; keep going instead.
+    ch.hp = ch.max_hp
+    ch.sanity = ch.max_sanity
+    top_up_bullets(manager, bullets, rand)
+
+    times = main.step(manager, buff)
+    update += times[0]
+    light += times[1]
+    render += times[2]
+
+  main.UpKeys.release_key(pygame.K_RIGHT)
+  main.end_world(manager)
+  main.Map.level = None
+  main.Map.baked = None
+
+  return update / frames * 1000, light / frames * 1000, render / frames * 1000
+
+def scale(dimension, frames, profile=False):
+  print "%s (everything else as BASELINE), ms per frame" % dimension
+  print "%8s %8s %8s %8s %8s %10s" % (dimension, "update", "light", "render", "total", "per extra")
+
+  first = None
+  for value in SCALES[dimension]:
+    settings = dict(BASELINE)
+    settings[dimension] = value
+
+    if profile and value == SCALES[dimension][-1]:
+      profiler = cProfile.Profile()
+      times = profiler.runcall(run, frames, **settings)
+    else:
+      times = run(frames, **settings)
+
+    total = sum(times)
+    if first is None:
+      first = (value, total)
+      extra = ""
+    else:
+      extra = "%10.4f" % ((total - first[1]) / (value - first[0]))
+
+    print "%8d %8.3f %8.3f %8.3f %8.3f %10s" % ((value,) + times + (total, extra))
+
+  if profile:
+    pstats.Stats(profiler).sort_stats("tottime").print_stats(12)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Time the game in made up rooms full of stuff.")
+  parser.add_argument("dimensions", nargs="*", help="what to scale: %s (default: all of them)" % ", ".join(DIMENSIONS))
+  parser.add_argument("--frames", type=int, default=200, help="frames per run")
+  parser.add_argument("--profile", action="store_true", help="profile the biggest run of each dimension")
+  args = parser.parse_args()
+
+  for dimension in args.dimensions:
+    if dimension not in DIMENSIONS: parser.error("don't know how to scale %s" % dimension)
+
+  pygame.init()
+  pygame.display.set_mode((1, 1))
+
+  for dimension in args.dimensions or DIMENSIONS:
+    scale(dimension, args.frames, args.profile)
+    print